@@ -0,0 +1,80 @@
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+from __future__ import print_function
+
+import json
+import os
+import os.path
+import shutil
+from subprocess import Popen, PIPE, check_call, check_output
+import sys
+import tempfile
+import time
+
+from parser import Parser
+
+# Terms of the '&' chains of the generated modules
+SIZES = [1000, 5000, 20000]
+
+
+def generate(directory, size):
+    path = os.path.join(directory, 'concat_{0}.vba'.format(size))
+    with open(path, 'w') as f:
+        f.write('Sub Concat()\n')
+        f.write('    s = ' + ' & '.join('"{0:04x}"'.format(i % 0x10000) for i in range(size)) + '\n')
+        f.write('End Sub\n')
+    return path
+
+
+def build_baseline(directory, ref):
+    # The grammar did not change: only VBA.java is built from the baseline
+    root = os.path.dirname(os.path.abspath(__file__))
+    source = os.path.join(directory, 'VBA.java')
+    with open(source, 'wb') as f:
+        f.write(check_output(['git', 'show', '{0}:parser/VBA.java'.format(ref)], cwd=root))
+    jars = Parser._jars()
+    classes = os.path.join(root, 'parser', '__class__')
+    check_call(['javac', '-cp', ':'.join(jars[1:] + [classes]), '-d', directory, source])
+    return [directory, classes] + jars[1:]
+
+
+def run(classpath, path):
+    # The tree is None when the module could not be parsed: both versions
+    # print an ERROR line for a syntax error, the baseline in the middle of
+    # its output
+    start = time.time()
+    proc = Popen(['java', '-cp', ':'.join(classpath), 'VBA', path], stdout=PIPE, stderr=PIPE)
+    (out, _) = proc.communicate()
+    elapsed = time.time() - start
+    out = out.decode('utf-8')
+    if proc.returncode != 0 or 'ERROR' in out.splitlines():
+        return (elapsed, None)
+    try:
+        return (elapsed, json.loads(out))
+    except ValueError:
+        return (elapsed, None)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('Expected 1 argument: git revision of the parser to compare with')
+        sys.exit(-1)
+    directory = tempfile.mkdtemp()
+    try:
+        baseline = build_baseline(directory, sys.argv[1])
+        for size in SIZES:
+            path = generate(directory, size)
+            (before, expected) = run(baseline, path)
+            (after, tree) = run(Parser._jars(), path)
+            if expected is None or tree is None:
+                outcome = '{0} failed'.format('baseline' if expected is None else 'parser')
+            else:
+                outcome = 'same tree' if expected == tree else 'DIFFERENT TREE'
+            print('{0:6} terms: {1:8.2f}s -> {2:8.2f}s {3}'.format(size, before, after, outcome))
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,97 @@
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+from __future__ import print_function
+
+import errno
+import os
+import tempfile
+import zlib
+
+class DiskCache(object):
+
+    def __init__(self, path, max_size):
+        self._path = path
+        self._max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._size = sum(size for (_, _, size) in self._entries())
+
+    def _file(self, key):
+        return os.path.join(self._path, key[:2], key)
+
+    def _entries(self):
+        entries = []
+        for (dirpath, _, filenames) in os.walk(self._path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, path, stat.st_size))
+        return entries
+
+    def get(self, key):
+        path = self._file(key)
+        try:
+            with open(path, 'rb') as f:
+                data = zlib.decompress(f.read())
+        except (IOError, zlib.error):
+            self.misses += 1
+            return None
+        # The modification time records the last use, for LRU eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        path = self._file(key)
+        data = zlib.compress(data)
+        try:
+            os.mkdir(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # Other workers may share the cache: only ever expose complete files
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # Replacing an entry only adds the difference
+        try:
+            self._size -= os.path.getsize(path)
+        except OSError:
+            pass
+        os.rename(tmp, path)
+        self._size += len(data)
+        if self._size > self._max_size:
+            self._evict()
+
+    def _evict(self):
+        entries = sorted(self._entries())
+        self._size = sum(size for (_, _, size) in entries)
+        for (_, path, size) in entries:
+            if self._size <= self._max_size * 0.9:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            self._size -= size
+
+    def stats(self):
+        total = self.hits + self.misses
+        return '{0} hits, {1} misses ({2:.0%} hit rate)'.format(self.hits, self.misses,
+                                                                float(self.hits) / total if total else 0)
@@ -0,0 +1,209 @@
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+from __future__ import print_function
+
+from heapq import heapify, heappop, heappush
+
+from dataflow import Dataflow
+
+class CallGraph(object):
+    # The names each procedure depends on, and the other way round the
+    # procedures using each name. Kept up to date procedure by procedure:
+    # whoever changes a procedure calls changed(), renaming or removing one
+    # goes through rename() and remove().
+    #
+    # A procedure depends on the identifiers it uses but its own name, its
+    # arguments and its locals. It uses a global variable even when it
+    # shadows it with a local of the same name.
+
+    def __init__(self, procs, variables):
+        # The Deobfuscator's name -> node dicts, followed as they change
+        self._procs = procs
+        self._vars = variables
+        # Procedure nodes, by id, and the other way round
+        self._names = {}
+        self._nodes = {}
+        # Procedure -> identifiers, and what it depends on
+        self._identifiers = {}
+        self._deps = {}
+        # Name -> procedures using it, or depending on it
+        self._using = {}
+        self._depending = {}
+        for proc in procs:
+            self._add(proc)
+
+    @classmethod
+    def _index(cls, index, proc, names):
+        for name in names:
+            try:
+                index[name].add(proc)
+            except KeyError:
+                index[name] = set([proc])
+
+    @classmethod
+    def _unindex(cls, index, proc, names):
+        for name in names:
+            users = index[name]
+            users.discard(proc)
+            if not users:
+                del index[name]
+
+    def _add(self, proc):
+        node = self._procs[proc]
+        dataflow = Dataflow.of(node)
+        identifiers = set(dataflow.identifiers)
+        identifiers.discard(proc)
+        deps = identifiers.difference(dataflow.arguments, dataflow.local_variables)
+        self._names[id(node)] = proc
+        self._nodes[proc] = id(node)
+        self._identifiers[proc] = identifiers
+        self._deps[proc] = deps
+        self._index(self._using, proc, identifiers)
+        self._index(self._depending, proc, deps)
+
+    def remove(self, proc):
+        if proc not in self._deps:
+            return
+        self._unindex(self._using, proc, self._identifiers.pop(proc))
+        self._unindex(self._depending, proc, self._deps.pop(proc))
+        del self._names[self._nodes.pop(proc)]
+
+    def update(self, proc):
+        self.remove(proc)
+        if proc in self._procs:
+            self._add(proc)
+
+    def changed(self, node):
+        # Something below node changed: updates its procedure, if any
+        while node is not None:
+            proc = self._names.get(id(node))
+            if proc is not None and self._procs.get(proc) is node:
+                self.update(proc)
+                return
+            node = node.get('parent')
+
+    def rename(self, renamed):
+        # After a global rename: old -> new identifiers. The procedure
+        # names have already been changed in the dicts.
+        touched = [proc for (proc, identifiers) in self._identifiers.items()
+                   if proc in renamed or not identifiers.isdisjoint(renamed)]
+        for proc in touched:
+            self.remove(proc)
+        for proc in touched:
+            proc = renamed.get(proc, proc)
+            if proc in self._procs:
+                self._add(proc)
+
+    def deps(self, proc):
+        return self._deps[proc]
+
+    def callers(self, name):
+        # Procedures depending on a global variable or procedure
+        callers = set()
+        if name in self._vars:
+            callers.update(self._using.get(name, ()))
+        if name in self._procs:
+            callers.update(self._depending.get(name, ()))
+        return callers
+
+    def variable_users(self, name):
+        if name not in self._vars:
+            return set()
+        return set(self._depending.get(name, ()))
+
+    def dependencies(self):
+        # (proc_dep, reverse_dep, var_dep) dicts, for the passes to work on.
+        # Filled in the procedures order, as a rebuild from the tree would.
+        proc_dep = {}
+        reverse_dep = {}
+        var_dep = {}
+        for proc in self._procs:
+            deps = self._deps[proc]
+            proc_dep[proc] = set(deps)
+            for name in self._identifiers[proc]:
+                if name in self._vars or (name in self._procs and name in deps):
+                    reverse_dep.setdefault(name, set()).add(proc)
+            for name in deps:
+                if name in self._vars:
+                    var_dep.setdefault(name, set()).add(proc)
+        return (proc_dep, reverse_dep, var_dep)
+
+    @classmethod
+    def components(cls, deps, order):
+        # Tarjan's strongly connected components of deps (name -> names it
+        # depends on, all in order), without recursion. The components come
+        # out dependencies first.
+        index = {}
+        low = {}
+        stack = []
+        on_stack = set()
+        components = []
+        for root in order:
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            work = [(root, iter(deps[root]))]
+            while work:
+                (name, edges) = work[-1]
+                for dep in edges:
+                    if dep not in index:
+                        index[dep] = low[dep] = len(index)
+                        stack.append(dep)
+                        on_stack.add(dep)
+                        work.append((dep, iter(deps[dep])))
+                        break
+                    if dep in on_stack:
+                        low[name] = min(low[name], index[dep])
+                else:
+                    work.pop()
+                    if work:
+                        caller = work[-1][0]
+                        low[caller] = min(low[caller], low[name])
+                    if low[name] == index[name]:
+                        component = []
+                        while True:
+                            dep = stack.pop()
+                            on_stack.discard(dep)
+                            component.append(dep)
+                            if dep == name:
+                                break
+                        components.append(component)
+        return components
+
+    @classmethod
+    def schedule(cls, deps, order):
+        # Kahn's algorithm on the components: each one comes once all those
+        # it depends on came and, among the ready ones, the first in order
+        # comes first. Members of a component are in order too.
+        position = dict((name, i) for (i, name) in enumerate(order))
+        components = cls.components(deps, order)
+        component_of = {}
+        for (i, component) in enumerate(components):
+            component.sort(key=position.get)
+            for name in component:
+                component_of[name] = i
+        waiting = [0] * len(components)
+        dependents = [[] for _ in components]
+        for (i, component) in enumerate(components):
+            targets = set(component_of[dep] for name in component for dep in deps[name])
+            targets.discard(i)
+            waiting[i] = len(targets)
+            for target in targets:
+                dependents[target].append(i)
+        # Ready components by the position of their first member
+        ready = [(position[components[i][0]], i) for i in range(len(components)) if not waiting[i]]
+        heapify(ready)
+        while ready:
+            (_, i) = heappop(ready)
+            yield components[i]
+            for j in dependents[i]:
+                waiting[j] -= 1
+                if not waiting[j]:
+                    heappush(ready, (position[components[j][0]], j))
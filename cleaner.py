@@ -7,7 +7,8 @@
 
 from __future__ import print_function
 
-from copy import copy,deepcopy
+from heapq import heappop, heappush
+from dataflow import Dataflow
 from parser import Parser
 
 class Cleaner(object):
@@ -55,37 +56,137 @@ class Cleaner(object):
         self._variable_unused = set()
         self._debug = debug
         self._failed = False
+        # Identifiers looked at by the top-level statement being handled
+        self._identifiers = set()
+        # Variable -> definitions made by the statements setting it
+        self._definitions = {}
 
     def debug(self, line):
         if self._debug:
             print('Cleaner: {0}'.format(line))
 
     def clean(self, node, name):
+        # Dead statements are removed until a fixpoint. The first pass
+        # handles every top-level statement of the procedure; after that a
+        # statement is only handled again if the outcome may differ: it
+        # looked at a variable that became unused, or that gained or lost a
+        # setter whose definitions may reach it, or it lost statements of
+        # its own.
         self._failed = False
-        while self._changed:
-            self._changed = False
-            (sideeffects, var_used, _) = self._handle(node)
+        self._blocks = Parser.xpath(node, ['block'])
+        self._statements = [(block, child) for block in self._blocks for child in block.get('children', [])]
+        count = len(self._statements)
+        # Definitions that may have run before each statement
+        self._dataflow = Dataflow.of(node)
+        self._before = [self._dataflow.defined_before(child) for (_, child) in self._statements]
+        self._kept = [True] * count
+        self._reads = [set() for _ in range(count)]
+        self._writes = [set() for _ in range(count)]
+        self._seen = [set() for _ in range(count)]
+        self._readcount = {}
+        self._setters = {}
+        self._definitions = {}
+        self._readers = {}
+        self._candidates = set()
+        self._dirty = list(range(count))
+        self._queued = set(self._dirty)
+        self._next = set()
+        while self._dirty:
+            removed = []
+            while self._dirty:
+                index = heappop(self._dirty)
+                self._queued.discard(index)
+                if self._kept[index] and not self._handle_statement(index):
+                    removed.append(index)
             if self._failed:
                 self.debug('Cannot handle script, failing through')
+                self._rebuild()
                 return (False, [], [])
-            set_external_vars = set()
-            previous_unused = copy(self._variable_unused)
-            for var in self._var_set:
-                if var in var_used:
-                    continue
-                if var in self._external_vars:
-                    set_external_vars.add(var)
-                    continue
-                if var == name:
-                    continue
-                self.debug('{0} set but not used: ignoring'.format(var))
-                self._variable_unused.add(var)
-            if previous_unused != self._variable_unused:
-                self._changed = True
-            used_external_vars = self._external_vars.intersection(var_used)
-            self._var_set = set()
+            self._find_unused(name)
+            for index in self._next:
+                self._mark(index)
+            self._next = set()
+            # Removed statements still counted as setters until now
+            for index in removed:
+                self._update(index, set(), set(), set())
+        self._rebuild()
+        set_external_vars = set(var for var in self._external_vars
+                                if self._setters.get(var) and not self._readcount.get(var))
+        used_external_vars = set(var for var in self._external_vars if self._readcount.get(var))
         return (True, set_external_vars, used_external_vars)
 
+    def _mark(self, index):
+        if self._kept[index] and index not in self._queued:
+            self._queued.add(index)
+            heappush(self._dirty, index)
+
+    def _handle_statement(self, index):
+        (_, statement) = self._statements[index]
+        self._var_set = set()
+        self._identifiers = set()
+        self._changed = False
+        (sideeffect, var_read, _) = self._handle(statement)
+        if self._changed:
+            self._next.add(index)
+        if not sideeffect:
+            child_text = Parser.get_node_text(statement)
+            if child_text != ['\n']:
+                self.debug('Removing {0}'.format(child_text))
+            self._kept[index] = False
+            self._update(index, set(), self._var_set, set())
+            return False
+        self._update(index, set(var_read), self._var_set, self._identifiers)
+        return True
+
+    def _update(self, index, reads, writes, identifiers):
+        for var in self._reads[index] - reads:
+            self._readcount[var] -= 1
+            if not self._readcount[var]:
+                self._candidates.add(var)
+        for var in reads - self._reads[index]:
+            self._readcount[var] = self._readcount.get(var, 0) + 1
+        for var in self._seen[index] - identifiers:
+            self._readers[var].discard(index)
+        for var in identifiers - self._seen[index]:
+            self._readers.setdefault(var, set()).add(index)
+        changed = self._writes[index] ^ writes
+        self._reads[index] = reads
+        self._seen[index] = identifiers
+        self._writes[index] = set(writes)
+        for var in changed:
+            setters = self._setters.setdefault(var, set())
+            definitions = self._dataflow.definitions(self._statements[index][1], var)
+            if var in writes:
+                setters.add(index)
+                self._candidates.add(var)
+                self._definitions[var] = self._definitions.get(var, 0) | definitions
+            else:
+                setters.discard(index)
+                self._definitions[var] = self._definitions.get(var, 0) & ~definitions
+            # Whether the variable may be set before a statement changed for
+            # the other ones these definitions reach (the statement making
+            # them sees its own, through a loop, once handled again)
+            for reader in list(self._readers.get(var, [])):
+                if reader != index and self._before[reader] & definitions:
+                    self._mark(reader)
+
+    def _find_unused(self, name):
+        for var in self._candidates:
+            if var in self._variable_unused or not self._setters.get(var) or self._readcount.get(var):
+                continue
+            if var in self._external_vars or var == name:
+                continue
+            self.debug('{0} set but not used: ignoring'.format(var))
+            self._variable_unused.add(var)
+            for reader in self._readers.get(var, []):
+                self._next.add(reader)
+        self._candidates = set()
+
+    def _rebuild(self):
+        for block in self._blocks:
+            res = [child for ((parent, child), kept) in zip(self._statements, self._kept) if parent is block and kept]
+            Parser.separate(block, res)
+
     def __handle_and_combine(self, nodes):
         children = [self._handle(child) for child in nodes]
         sideeffect = any(child[0] for child in children)
@@ -94,24 +195,47 @@ class Cleaner(object):
         return (sideeffect, var_read, var_set)
 
     def _pass_though(self, node):
-        if 'children' not in node:
-            return (False, [], [])
-        return self.__handle_and_combine(node['children'])
+        # Without recursing through the pass through nodes: long
+        # expressions are deeper than the recursion limit
+        sideeffect = False
+        var_read = set()
+        var_set = set()
+        stack = list(reversed(node.get('children', [])))
+        while stack:
+            child = stack.pop()
+            if child['name'] in self._PASS_THROUGH:
+                stack.extend(reversed(child.get('children', [])))
+                continue
+            result = self._handle(child)
+            sideeffect = sideeffect or result[0]
+            var_read.update(result[1])
+            var_set.update(result[2])
+        return (sideeffect, list(var_read), list(var_set))
+
+    def _no_side_effect(self, node):
+        return (False, [], [])
+
+    def _side_effect(self, node):
+        return (True, [], [])
+
+    @classmethod
+    def _dispatch_table(cls):
+        # Node name -> handler, the categories taking precedence
+        table = Parser.dispatch_table(cls)
+        for (names, handler) in [(cls.SIDE_EFFECT, '_side_effect'),
+                                 (cls.PASS_THROUGH, '_pass_though'),
+                                 (cls.NO_SIDE_EFFECT, '_no_side_effect')]:
+            table.update((name, vars(Cleaner)[handler]) for name in names)
+        return table
 
     def _handle(self, node):
-        if node['name'] in self.NO_SIDE_EFFECT:
-            return (False, [], [])
-        if node['name'] in self.PASS_THROUGH:
-            return self._pass_though(node)
-        if node['name'] in self.SIDE_EFFECT:
-            return (True, [], [])
         try:
-            func = getattr(self, '_handle_{0}'.format(node['name']))
-        except AttributeError:
+            func = self._DISPATCH[node['name']]
+        except KeyError:
             self._failed = True
             self.debug("Can't handle: " + node['name'])
             return (True, [], [])
-        return func(node)
+        return func(self, node)
 
     def __check_and_remove(self, node, children):
         res = []
@@ -120,6 +244,8 @@ class Cleaner(object):
         for child in children:
             (sideeffect, var_read, var_set) = self._handle(child)
             if not sideeffect:
+                if Parser.is_newline(child):
+                    continue
                 child_text = Parser.get_node_text(child)
                 if child_text == ['\n']:
                     continue
@@ -129,10 +255,9 @@ class Cleaner(object):
             vars_set.update(var_set)
             vars_read.update(var_read)
             res.append(child)
+        Parser.separate(node, res)
         if len(res) == 0:
-            node['children'] = []
             return (False, [], [])
-        node['children'] =  [item for child in res for item in (child, Parser.newline())]
         return (True, list(vars_read), list(vars_set))
 
     def _handle_block(self, node):
@@ -146,10 +271,17 @@ class Cleaner(object):
     _handle_functionStmt = _handle_subcalls
     _handle_subStmt = _handle_subcalls
 
+    def _set_before(self, node):
+        # By the statement being handled so far, or by a definition that may
+        # have run before node is read
+        var = node['value']
+        return var in self._var_set or bool(self._dataflow.defined_before_at(node) & self._definitions.get(var, 0))
+
     def _handle_IDENTIFIER(self, node):
         if node['value'] in self.NO_SIDE_EFFECT_IDENTIFIER:
             return (False, [], [])
-        if node['value'] in self._variable_unused or node['value'] in self._var_set:
+        self._identifiers.add(node['value'])
+        if node['value'] in self._variable_unused or self._set_before(node):
             return (False, [node['value']], [])
         return (True, [node['value']], [])
 
@@ -218,3 +350,6 @@ class Cleaner(object):
 
     _handle_forEachStmt = __handle_loop
     _handle_forNextStmt = __handle_loop
+
+Cleaner._PASS_THROUGH = frozenset(Cleaner.PASS_THROUGH)
+Cleaner._DISPATCH = Cleaner._dispatch_table()
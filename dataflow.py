@@ -0,0 +1,573 @@
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+from __future__ import print_function
+
+from parser import Parser
+
+class BasicBlock(object):
+
+    def __init__(self, index):
+        self.index = index
+        self.statements = []
+        self.successors = []
+        self.predecessors = []
+
+class Dataflow(object):
+    # Def-use analysis of a procedure: liveness, and the definitions that
+    # may have run before each statement. The statements are grouped in
+    # basic blocks, linked by the If, Select, For, For Each, Do and While
+    # structure, Exit and GoTo. Sets of variables (and of definitions) are
+    # bit vectors: one bit per variable (definition) of the procedure.
+    #
+    # Anything not understood is conservative: every identifier in it is a
+    # use, On Error GoTo may jump from anywhere to any label, Resume to any
+    # statement, and every variable that is not declared in the procedure
+    # (arguments, globals, implicit locals) is live at its end.
+
+    ASSIGNMENTS = ['letStmt', 'setStmt', 'lsetStmt', 'rsetStmt']
+    LOOPS = {'EXIT_DO': 'doLoopStmt', 'EXIT_FOR': 'forNextStmt'}
+    NAMES = frozenset(['arguments', 'local_variables', 'identifiers'])
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.name = Parser.identifier_name(proc)
+        self._built = False
+        self._liveness = None
+        self._before = None
+        self._located = None
+
+    def __getattr__(self, key):
+        # Only called for unset attributes: the names of the procedure and
+        # the control flow graph are computed on first use
+        if key in self.NAMES:
+            self._find_names()
+            return getattr(self, key)
+        if key.startswith('__') or self._built:
+            raise AttributeError(key)
+        self._build()
+        return getattr(self, key)
+
+    def _find_names(self):
+        self.arguments = Parser.proc_arguments(self.proc)
+        self.local_variables = Parser.local_variables(self.proc)
+        # Known without loading the lazy blocks of the procedure
+        self.identifiers = frozenset(Parser.getallidentifiers(self.proc))
+
+    def _build(self):
+        self._built = True
+        self.variables = []
+        self._bits = {}
+        # Statement nodes (or the parts of a control statement, like a
+        # condition), with the variables they use and define
+        self.statements = []
+        self._uses = []
+        self._defs = []
+        self._block_of = []
+        self._position = {}
+        # Block statement -> range of the statements it is made of
+        self._extent = {}
+        self.blocks = []
+        self._labels = []
+        self._jumps = []
+        self._loops = []
+        self._declared = 0
+        self.entry = self._new_block()
+        self.exit = self._new_block()
+        current = self._new_block()
+        self._edge(self.entry, current)
+        for block in Parser.xpath(self.proc, ['block']):
+            current = self._block(block, current)
+        self._edge(current, self.exit)
+        self._resolve_jumps()
+
+    @classmethod
+    def of(cls, proc):
+        # Cached in the index of the tree, which forgets it once something
+        # in the procedure changes
+        index = getattr(proc, 'index', None)
+        if index is None:
+            return cls(proc)
+        key = ('dataflow', id(proc))
+        try:
+            return index.cache[key]
+        except KeyError:
+            return index.store(key, proc, cls(proc))
+
+    # Construction
+
+    def _new_block(self):
+        block = BasicBlock(len(self.blocks))
+        self.blocks.append(block)
+        return block
+
+    @classmethod
+    def _edge(cls, source, target):
+        source.successors.append(target)
+        target.predecessors.append(source)
+
+    def _mask(self, names):
+        mask = 0
+        for name in names:
+            try:
+                bit = self._bits[name]
+            except KeyError:
+                bit = self._bits[name] = len(self.variables)
+                self.variables.append(name)
+            mask |= 1 << bit
+        return mask
+
+    def _add(self, node, block, uses=None, defs=()):
+        if uses is None:
+            uses = Parser.getallidentifiers(node)
+        self._position[id(node)] = len(self.statements)
+        self.statements.append(node)
+        self._uses.append(self._mask(uses))
+        self._defs.append(self._mask(defs))
+        self._block_of.append(block)
+        block.statements.append(len(self.statements) - 1)
+
+    @classmethod
+    def _target(cls, node):
+        # The variable set by an assignment, if it is a plain variable
+        calls = Parser.xpath(node, ['implicitCallStmt_InStmt', 'iCS_S_VariableOrProcedureCall'])
+        if len(calls) != 1:
+            return None
+        if any(child['name'] not in ['ambiguousIdentifier', 'typeHint'] for child in calls[0]['children']):
+            return None
+        return Parser.identifier_name(calls[0])
+
+    def _block(self, node, current):
+        for child in node.get('children', []):
+            if child['name'] == 'blockStmt':
+                start = len(self.statements)
+                current = self._statement(child['children'][0], current)
+                self._extent[id(child)] = (start, len(self.statements))
+        return current
+
+    def _branch(self, node, current):
+        # A block of statements reached from current
+        block = self._new_block()
+        self._edge(current, block)
+        if node['name'] == 'block':
+            return self._block(node, block)
+        return self._statement(node, block)
+
+    def _statement(self, node, current):
+        name = node['name']
+        handler = self._DISPATCH.get(name)
+        if handler is not None:
+            return handler(self, node, current)
+        if name in self.ASSIGNMENTS:
+            target = self._target(node)
+            operators = [child['name'] for child in node['children']]
+            if target is None or "'+='" in operators or "'-='" in operators:
+                self._add(node, current)
+            else:
+                uses = set()
+                for child in node['children']:
+                    if child['name'] == 'valueStmt':
+                        Parser.getallidentifiers(child, acc=uses)
+                self._add(node, current, uses=uses, defs=[target])
+            return current
+        self._add(node, current)
+        return current
+
+    def _statement_variableStmt(self, node, current):
+        names = []
+        uses = set()
+        for sub_stmt in Parser.findall(node, 'variableSubStmt'):
+            names.append(Parser.identifier_name(sub_stmt))
+            for child in sub_stmt['children']:
+                if child['name'] != 'ambiguousIdentifier':
+                    Parser.getallidentifiers(child, acc=uses)
+        names = [name for name in names if name]
+        self._add(node, current, uses=uses, defs=names)
+        # Static variables outlive the call
+        if not Parser.xpath_first(node, ['STATIC']):
+            self._declared |= self._mask(names)
+        return current
+
+    def _statement_constStmt(self, node, current):
+        for sub_stmt in Parser.findall(node, 'constSubStmt'):
+            name = Parser.identifier_name(sub_stmt)
+            uses = set()
+            for child in sub_stmt['children']:
+                if child['name'] != 'ambiguousIdentifier':
+                    Parser.getallidentifiers(child, acc=uses)
+            self._add(sub_stmt, current, uses=uses, defs=[name] if name else [])
+            self._declared |= self._mask([name] if name else [])
+        return current
+
+    def _statement_lineLabel(self, node, current):
+        block = self._new_block()
+        self._edge(current, block)
+        self._add(node, block, uses=())
+        self._labels.append(block)
+        return block
+
+    def _jump(self, node, current, fallthrough, target):
+        self._add(node, current)
+        self._jumps.append((current, target))
+        if fallthrough:
+            return current
+        return self._new_block()
+
+    def _statement_goToStmt(self, node, current):
+        return self._jump(node, current, False, 'label')
+
+    def _statement_onGoToStmt(self, node, current):
+        return self._jump(node, current, True, 'label')
+
+    def _statement_goSubStmt(self, node, current):
+        return self._jump(node, current, True, 'label')
+
+    _statement_onGoSubStmt = _statement_goSubStmt
+
+    def _statement_onErrorStmt(self, node, current):
+        if Parser.xpath_first(node, ['GOTO']) is None:
+            self._add(node, current)
+            return current
+        return self._jump(node, current, True, 'error')
+
+    def _statement_resumeStmt(self, node, current):
+        return self._jump(node, current, False, 'resume')
+
+    def _statement_exitStmt(self, node, current):
+        self._add(node, current, uses=())
+        kind = node['children'][0]['name']
+        target = self.exit
+        if kind in self.LOOPS:
+            for (loop, exit) in reversed(self._loops):
+                if loop == self.LOOPS[kind] or (kind == 'EXIT_FOR' and loop == 'forEachStmt'):
+                    target = exit
+                    break
+        self._edge(current, target)
+        return self._new_block()
+
+    def _statement_endStmt(self, node, current):
+        self._add(node, current, uses=())
+        self._edge(current, self.exit)
+        return self._new_block()
+
+    _statement_stopStmt = _statement_endStmt
+
+    def _statement_ifThenElseStmt(self, node, current):
+        join = self._new_block()
+        if Parser.xpath_first(node, ['ifBlockStmt']) is None:
+            # Single line If
+            self._add(Parser.xpath_first(node, ['ifConditionStmt']), current)
+            statements = Parser.xpath(node, ['blockStmt'])
+            self._edge(self._branch(statements[0]['children'][0], current), join)
+            if len(statements) > 1:
+                self._edge(self._branch(statements[1]['children'][0], current), join)
+            else:
+                self._edge(current, join)
+            return join
+        test = current
+        for child in node['children']:
+            if child['name'] not in ['ifBlockStmt', 'ifElseIfBlockStmt', 'ifElseBlockStmt']:
+                continue
+            condition = Parser.xpath_first(child, ['ifConditionStmt'])
+            if condition is not None:
+                self._add(condition, test)
+            body = Parser.xpath_first(child, ['block'])
+            if body is None:
+                self._edge(test, join)
+            else:
+                self._edge(self._branch(body, test), join)
+            if condition is None:
+                # Else
+                return join
+            block = self._new_block()
+            self._edge(test, block)
+            test = block
+        self._edge(test, join)
+        return join
+
+    def _statement_selectCaseStmt(self, node, current):
+        join = self._new_block()
+        self._add(Parser.xpath_first(node, ['valueStmt']), current)
+        test = current
+        for case in Parser.xpath(node, ['sC_Case']):
+            condition = Parser.xpath_first(case, ['sC_Cond'])
+            block = self._new_block()
+            self._edge(test, block)
+            test = block
+            self._add(condition, test)
+            body = Parser.xpath_first(case, ['block'])
+            if body is None:
+                self._edge(test, join)
+            else:
+                self._edge(self._branch(body, test), join)
+            if Parser.xpath_first(condition, ['ELSE']) is not None:
+                return join
+        self._edge(test, join)
+        return join
+
+    def _loop(self, node, current, header_statements, test_at_end=None):
+        # header_statements: (node, uses, defs) evaluated on each iteration
+        # before the body, test_at_end a condition evaluated after it
+        header = self._new_block()
+        exit = self._new_block()
+        self._edge(current, header)
+        for (statement, uses, defs) in header_statements:
+            self._add(statement, header, uses=uses, defs=defs)
+        self._loops.append((node['name'], exit))
+        body = Parser.xpath_first(node, ['block'])
+        end = header
+        if body is not None:
+            end = self._branch(body, header)
+        self._loops.pop()
+        if test_at_end is not None:
+            self._add(test_at_end, end)
+        self._edge(end, header)
+        if header_statements or test_at_end is not None:
+            self._edge(header if test_at_end is None else end, exit)
+        return exit
+
+    def _statement_forNextStmt(self, node, current):
+        var = Parser.identifier_name(node)
+        uses = set()
+        for child in Parser.xpath(node, ['valueStmt']):
+            Parser.getallidentifiers(child, acc=uses)
+        # Bounds are evaluated once, then the counter is tested and stepped
+        self._add(node, current, uses=uses, defs=[var] if var else [])
+        step = [(Parser.xpath_first(node, ['ambiguousIdentifier']), [var] if var else [], [var] if var else [])]
+        return self._loop(node, current, step)
+
+    def _statement_forEachStmt(self, node, current):
+        var = Parser.identifier_name(node)
+        self._add(Parser.xpath_first(node, ['valueStmt']), current)
+        return self._loop(node, current, [(Parser.xpath_first(node, ['ambiguousIdentifier']), [], [var] if var else [])])
+
+    def _statement_doLoopStmt(self, node, current):
+        condition = Parser.xpath_first(node, ['valueStmt'])
+        if condition is None:
+            return self._loop(node, current, [])
+        if node['children'][-1] is condition:
+            return self._loop(node, current, [], test_at_end=condition)
+        return self._loop(node, current, [(condition, None, [])])
+
+    def _statement_whileWendStmt(self, node, current):
+        return self._loop(node, current, [(Parser.xpath_first(node, ['valueStmt']), None, [])])
+
+    def _statement_withStmt(self, node, current):
+        target = [child for child in node['children'] if child['name'] not in ['block', 'endOfStatement']]
+        self._add(node, current, uses=set().union(*[Parser.getallidentifiers(child) for child in target]))
+        body = Parser.xpath_first(node, ['block'])
+        if body is None:
+            return current
+        return self._block(body, current)
+
+    def _resolve_jumps(self):
+        for (block, target) in self._jumps:
+            if target == 'label':
+                targets = self._labels
+            elif target == 'error':
+                # Any statement may fail
+                targets = self._labels
+                for source in self.blocks:
+                    if source.statements and source is not block:
+                        for label in self._labels:
+                            self._edge(source, label)
+            else:
+                targets = [other for other in self.blocks if other.statements]
+            for label in targets:
+                self._edge(block, label)
+
+    # Analyses
+
+    def _names(self, mask):
+        names = set()
+        bit = 0
+        while mask:
+            if mask & 1:
+                names.add(self.variables[bit])
+            mask >>= 1
+            bit += 1
+        return names
+
+    def _solve(self):
+        count = len(self.blocks)
+        use = [0] * count
+        kill = [0] * count
+        for block in self.blocks:
+            for statement in reversed(block.statements):
+                use[block.index] = (use[block.index] & ~self._defs[statement]) | self._uses[statement]
+                kill[block.index] |= self._defs[statement]
+        everything = (1 << len(self.variables)) - 1
+        live_in = [0] * count
+        live_out = [0] * count
+        live_out[self.exit.index] = everything & ~self._declared
+        live_in[self.exit.index] = live_out[self.exit.index]
+        worklist = list(self.blocks)
+        queued = set(block.index for block in worklist)
+        while worklist:
+            block = worklist.pop()
+            queued.discard(block.index)
+            if block is not self.exit:
+                out = 0
+                for successor in block.successors:
+                    out |= live_in[successor.index]
+                live_out[block.index] = out
+            new = use[block.index] | (live_out[block.index] & ~kill[block.index])
+            if new != live_in[block.index] or block is self.exit:
+                live_in[block.index] = new
+                for predecessor in block.predecessors:
+                    if predecessor.index not in queued:
+                        queued.add(predecessor.index)
+                        worklist.append(predecessor)
+        self._liveness = (live_in, live_out)
+
+    def live_in(self, block):
+        if self._liveness is None:
+            self._solve()
+        return self._names(self._liveness[0][block.index])
+
+    def live_out(self, block):
+        if self._liveness is None:
+            self._solve()
+        return self._names(self._liveness[1][block.index])
+
+    def _live_after(self, statement):
+        if self._liveness is None:
+            self._solve()
+        block = self._block_of[statement]
+        live = self._liveness[1][block.index]
+        for other in reversed(block.statements):
+            if other == statement:
+                return live
+            live = (live & ~self._defs[other]) | self._uses[other]
+        return live
+
+    def live_after(self, node):
+        # Statements nested in one the graph does not go into (like #If)
+        # have no position: any name of the procedure may be read after
+        position = self._position.get(id(node))
+        if position is None:
+            return set(self.identifiers)
+        return self._names(self._live_after(position))
+
+    def upward_exposed(self):
+        # Read before being set: arguments, globals, or uninitialized
+        return self.live_in(self.entry)
+
+    def defined(self):
+        mask = 0
+        for defs in self._defs:
+            mask |= defs
+        return self._names(mask)
+
+    def declared(self):
+        # Dim or Const, but not Static
+        return self._names(self._declared)
+
+    def uninitialized(self):
+        # Declared variables that may be read before being set
+        mask = 0
+        for (statement, node) in enumerate(self.statements):
+            if node['name'] == 'variableStmt':
+                mask |= self._defs[statement] & self._live_after(statement)
+        return self._names(mask)
+
+    def _solve_defined_before(self):
+        # Definitions that may have run before each statement, on some path
+        # from the entry. These are not reaching definitions: there are no
+        # kills, a definition overwritten on every path still counts. Whether
+        # a variable may be set at a statement does not depend on kills, and
+        # the answer stays right for a client dropping definitions. One bit
+        # per (statement, variable) definition.
+        gen = []
+        variables = {}
+        count = 0
+        for defs in self._defs:
+            mask = 0
+            bit = 0
+            while defs >> bit:
+                if (defs >> bit) & 1:
+                    mask |= 1 << count
+                    variables[bit] = variables.get(bit, 0) | (1 << count)
+                    count += 1
+                bit += 1
+            gen.append(mask)
+        block_gen = [0] * len(self.blocks)
+        for block in self.blocks:
+            for statement in block.statements:
+                block_gen[block.index] |= gen[statement]
+        reach_in = [0] * len(self.blocks)
+        worklist = list(reversed(self.blocks))
+        queued = set(block.index for block in worklist)
+        while worklist:
+            block = worklist.pop()
+            queued.discard(block.index)
+            out = reach_in[block.index] | block_gen[block.index]
+            for successor in block.successors:
+                if out & ~reach_in[successor.index]:
+                    reach_in[successor.index] |= out
+                    if successor.index not in queued:
+                        queued.add(successor.index)
+                        worklist.append(successor)
+        before = [0] * len(self.statements)
+        for block in self.blocks:
+            reach = reach_in[block.index]
+            for statement in block.statements:
+                before[statement] = reach
+                reach |= gen[statement]
+        self._before = (gen, variables, before)
+
+    def _range(self, node):
+        # The statements of a block statement, or the statement itself
+        if id(node) in self._extent:
+            return self._extent[id(node)]
+        position = self._position.get(id(node))
+        if position is None:
+            return (0, 0)
+        return (position, position + 1)
+
+    def defined_before(self, node):
+        # Definitions that may have run before a statement of node, as a
+        # bit vector
+        if self._before is None:
+            self._solve_defined_before()
+        mask = 0
+        for reach in self._before[2][slice(*self._range(node))]:
+            mask |= reach
+        return mask
+
+    def _locate(self):
+        # IDENTIFIER -> innermost statement evaluating it: statements are
+        # added before the ones nested in them
+        self._located = {}
+        for (statement, node) in enumerate(self.statements):
+            for identifier in Parser.findall(node, 'IDENTIFIER'):
+                self._located[id(identifier)] = statement
+
+    def defined_before_at(self, identifier):
+        # Definitions that may have run before an IDENTIFIER node is evaluated
+        if self._before is None:
+            self._solve_defined_before()
+        if self._located is None:
+            self._locate()
+        statement = self._located.get(id(identifier))
+        if statement is None:
+            return 0
+        return self._before[2][statement]
+
+    def definitions(self, node, variable=None):
+        # Definitions (of variable) made by the statements of node, as a
+        # bit vector comparable with defined_before()
+        if self._before is None:
+            self._solve_defined_before()
+        mask = 0
+        for defs in self._before[0][slice(*self._range(node))]:
+            mask |= defs
+        if variable is not None:
+            mask &= self._before[1].get(self._bits.get(variable), 0)
+        return mask
+
+Dataflow._DISPATCH = Parser.dispatch_table(Dataflow, prefix='_statement_')
@@ -7,16 +7,79 @@
 
 from __future__ import print_function
 
+import atexit
 import copy
+import hashlib
+import inspect
+import marshal
+import multiprocessing
 import re
 import string
-
+import sys
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    from importlib.util import MAGIC_NUMBER
+except ImportError:
+    from imp import get_magic
+    MAGIC_NUMBER = get_magic()
+
+from node import Node
 from parser import Parser
 from cleaner import Cleaner
+from callgraph import CallGraph
+from dataflow import Dataflow
 from translator import PROC_OK, Translator
-from interpretor import Interpretor
+from interpretor import EmulationPool, Interpretor, PooledInterpretor
+
+def _clean_procedure(job):
+    # In a pool process. The cleaner only replaces children lists: those
+    # are sent back, as the positions of the children kept and the new
+    # subtrees, along with the debug output
+    (data, name, known_var, debug) = job
+    proc = Node.loads(data)
+    nodes = list(Parser.walk(proc))
+    before = [node.get('children') for node in nodes]
+    output = StringIO()
+    stdout = sys.stdout
+    sys.stdout = output
+    try:
+        Cleaner(known_var=known_var, debug=debug).clean(proc, name)
+    finally:
+        sys.stdout = stdout
+    changes = []
+    for (position, node) in enumerate(nodes):
+        children = node.get('children')
+        if children is not before[position]:
+            kept = dict((id(child), index) for (index, child) in enumerate(before[position] or []))
+            changes.append((position, [kept.get(id(child)) if id(child) in kept else child.dumps()
+                                       for child in children]))
+    return (changes, output.getvalue())
 
 class Deobfuscator(Parser):
+    # Processes cleaning the procedures, 1 to clean them in this one
+    CLEAN_PROCESSES = 1
+    # The pool only pays off past that much serialized procedures, not
+    # counting the largest one
+    CLEAN_POOL_MIN_BYTES = 4 << 20
+    _clean_pool = None
+    # Translations and compiled procedures, shared between samples
+    CACHE = None
+    _translator_version = None
+    # Identifiers of the procedures as they are cached
+    CANONICAL = re.compile(r'_c(\d+)_')
+    # Processes emulating the translated procedures, 0 to do it in this
+    # one, and their limits: CPU seconds and wall clock seconds per
+    # evaluation, bytes of address space on top of the size of the worker
+    # when it starts (a fork of this process, trees and all)
+    EMULATION_WORKERS = 0
+    EMULATION_CPU = 10
+    EMULATION_MEMORY = 1 << 30
+    EMULATION_TIMEOUT = 30
+    _emulation_pool = None
+
     BASE_ATTR = set(['VB_Base', 'VB_Creatable', 'VB_Customizable', 'VB_Exposed', 'VB_GlobalNameSpace', 'VB_Name', 'VB_PredeclaredId', 'VB_TemplateDerived'])
     ARITHM = set(['literal', 'valueStmt', 'SHORTLITERAL', 'WS', "'-'", "'+'", "'('", "')'"])
 
@@ -29,15 +92,28 @@ class Deobfuscator(Parser):
         self._resolved = set()
         self._var = {}
         self._proc = {}
+        self._calls = None
         self._populate_vars()
         self._populate_proc()
-        self._interpretor = Interpretor()
+        if self.EMULATION_WORKERS:
+            self._interpretor = PooledInterpretor(self._get_emulation_pool())
+        else:
+            self._interpretor = Interpretor()
+        # Emulated call sites: text -> translation, (proc, translation) ->
+        # (value, error), and how often each was reused
+        self._call_codes = {}
+        self._call_values = {}
+        self._call_stats = {'calls': 0, 'translations': 0, 'values': 0}
+        self._emulated = set()
         self._debug = debug
+        self.debug('Normalization removed {0} bytes'.format(self.normalized))
 
     def debug(self, lines, ident=0):
         if self._debug:
+            if isinstance(lines, bytes):
+                lines = lines.decode('utf-8', 'replace')
             for line in lines.splitlines():
-                print('{0}{1}'.format(' '*ident, line))
+                print(u'{0}{1}'.format(' '*ident, line))
 
 
     def _populate_vars(self):
@@ -59,14 +135,18 @@ class Deobfuscator(Parser):
     def __remove_proc(self, node):
         moduleBodyElement = node['parent']
         assert(len(moduleBodyElement['children']) == 1)
-        parent_children = moduleBodyElement['parent']['children']
+        parent = moduleBodyElement['parent']
+        parent_children = parent['children']
         del moduleBodyElement['parent']
         index = parent_children.index(moduleBodyElement)
-        parent_children.pop(index)
-        if len(parent_children) > index and parent_children[index]['name'] == 'endOfLine':
-            parent_children.pop(index)
+        end = index + 1
+        if len(parent_children) > end and parent_children[end]['name'] == 'endOfLine':
+            end += 1
+        parent['children'] = parent_children[:index] + parent_children[end:]
 
     def _remove_proc(self, proc_name):
+        if self._calls is not None:
+            self._calls.remove(proc_name)
         for subst in self.findall(self.body, 'subStmt'):
             name = self.identifier_name(subst)
             if name == proc_name:
@@ -82,41 +162,18 @@ class Deobfuscator(Parser):
             self.getallidentifiers(self.decl, acc=self._known_identifier)
             self.getallidentifiers(self.body, acc=self._known_identifier)
 
-    def _proc_deps(self, proc_name):
-        proc = self._proc[proc_name]
-        ids = self.getallidentifiers(proc)
-        deps = set()
-        ids.discard(proc_name)
-        for id in self._var:
-            if id in ids:
-                deps.add(id)
-        for lst in [self.proc_arguments(proc), self.local_variables(proc)]:
-            for id in lst:
-                ids.discard(id)
-        for id in self._proc:
-            if id in ids:
-                deps.add(id)
-        return (ids, deps)
+    def _call_graph(self):
+        # Built on first use, then kept up to date by the passes
+        if self._calls is None:
+            self._calls = CallGraph(self._proc, self._var)
+        return self._calls
+
+    def _touched(self, node):
+        if self._calls is not None:
+            self._calls.changed(node)
 
     def _build_deps(self):
-        proc_dep = {}
-        reverse_dep = {}
-        var_dep = {}
-        for proc in self._proc:
-            (all_deps, proc_deps) = self._proc_deps(proc)
-            proc_dep[proc] = set(all_deps)
-            for dep in proc_deps:
-                try:
-                    reverse_dep[dep].add(proc)
-                except KeyError:
-                    reverse_dep[dep] = set([proc])
-            for var in self._var:
-                if var in all_deps:
-                    try:
-                        var_dep[var].add(proc)
-                    except KeyError:
-                        var_dep[var] = set([proc])
-        return (proc_dep, reverse_dep, var_dep)
+        return self._call_graph().dependencies()
 
     def _next_name(self):
         self._index +=1
@@ -141,78 +198,135 @@ class Deobfuscator(Parser):
                 dic[newname] = dic[oldname]
                 del dic[oldname]
 
-    def _rename(self, node, oldname, newname, update_global_id=False):
-        for identifier in self.findall(node, 'IDENTIFIER'):
-            if identifier['value'] == oldname:
+    def _renamed(self, oldnames, values, update_global_id=False):
+        # Renames oldnames in turn, as far as values are concerned: returns
+        # the new names and the final value of each value changed. A later
+        # old name may be given by an earlier rename, and global renames
+        # also change the values they prefix ("oldname_...").
+        images = dict((value, set([value])) for value in values)
+        prefixes = {}
+        if update_global_id:
+            for value in values:
+                prefixes.setdefault(value.split('_')[0], set()).add(value)
+        newnames = []
+        for oldname in oldnames:
+            newname = self._next_valid_name()
+            self.debug('Renaming {0} as {1}'.format(oldname, newname))
+            moves = []
+            if oldname in images:
+                moves.append((oldname, newname))
+            if update_global_id:
+                self._update_global_id(oldname, newname)
+                for image in sorted(prefixes.get(oldname, [])):
+                    if image != oldname:
+                        moves.append((image, newname + image[len(oldname):]))
+                        self._known_identifier.discard(image)
+                        self._update_global_id(image, newname + image[len(oldname):])
+            for (old, new) in moves:
+                if old == new:
+                    continue
+                images.setdefault(new, set()).update(images.pop(old))
+                if update_global_id:
+                    prefixes[old.split('_')[0]].discard(old)
+                    prefixes.setdefault(new.split('_')[0], set()).add(new)
+            self._known_identifier.discard(oldname)
+            newnames.append(newname)
+        renamed = {}
+        for (image, originals) in images.items():
+            for original in originals:
+                if original != image:
+                    renamed[original] = image
+        return (newnames, renamed)
+
+    def _apply_renamed(self, node, renamed):
+        index = getattr(node, 'index', None)
+        if index is None:
+            identifiers = self.findall(node, 'IDENTIFIER')
+        else:
+            # Blocks not using any of the names can stay unloaded
+            for lazy in index.pending(node):
+                if not lazy.identifiers.isdisjoint(renamed):
+                    lazy.load()
+            identifiers = index.findall(node, 'IDENTIFIER', load=False)
+        for identifier in identifiers:
+            newname = renamed.get(identifier['value'])
+            if newname is not None:
                 identifier['value'] = newname
-            elif update_global_id:
-                parts = identifier['value'].split('_')
-                if parts[0] == oldname:
-                    parts[0] = newname
-                    self._known_identifier.remove(identifier['value'])
-                    self._update_global_id(identifier['value'], '_'.join(parts))
-                    identifier['value'] = '_'.join(parts)
+
+    def rename_all(self, oldnames, node=None):
+        # Same as renaming each of oldnames in turn, in a single traversal
+        # of the tree
+        self._populate_identifiers()
+        nodes = [self.attr, self.decl, self.body] if node is None else [node]
+        values = set()
+        for scope in nodes:
+            self.getallidentifiers(scope, acc=values)
+        (newnames, renamed) = self._renamed(oldnames, values, update_global_id=node is None)
+        if renamed:
+            for scope in nodes:
+                self._apply_renamed(scope, renamed)
+            if node is None:
+                if self._calls is not None:
+                    self._calls.rename(renamed)
+            else:
+                self._touched(node)
+        return newnames
 
     def rename(self, oldname, node=None):
-        newname = self._next_valid_name()
-        self.debug('Renaming {0} as {1}'.format(oldname, newname))
-        if node is None:
-            self._update_global_id(oldname, newname)
-            self._rename(self.attr, oldname, newname, update_global_id=True)
-            self._rename(self.decl, oldname, newname, update_global_id=True)
-            self._rename(self.body, oldname, newname, update_global_id=True)
-        else:
-            self._rename(node, oldname, newname)
-        self._known_identifier.discard(oldname)
-        return newname
+        return self.rename_all([oldname], node)[0]
 
     def clean_ids(self):
+        order = set(self._identifier_order)
         for id in self._identifier_order:
             if id in self._proc:
                 proc = self._proc[id]
-                arguments = self.proc_arguments(proc)
-                variables = self.local_variables(proc)
-                for argument in arguments:
-                    self.rename(argument, proc)
-                for variable in variables:
-                    if (variable != id and
-                            variable not in arguments and
-                            variable not in self._identifier_order):
-                        self.rename(variable, proc)
-        (_, reverse_dep, var_dep) = self._build_deps()
-        for id in self._identifier_order:
-            if id in reverse_dep or id in var_dep:
-                new_name = self.rename(id)
+                dataflow = Dataflow.of(proc)
+                arguments = dataflow.arguments
+                variables = [variable for variable in dataflow.local_variables
+                             if variable != id and variable not in arguments and variable not in order]
+                self.rename_all(arguments + variables, proc)
+        calls = self._call_graph()
+        self.rename_all([id for id in self._identifier_order if calls.callers(id) or calls.variable_users(id)])
 
     def clean_arithmetic(self):
         for node in [self.attr, self.decl, self.body]:
+            # Backwards, children come before their parent: one pass tells
+            # which subtrees are only made of arithmetic
+            arithmetic = set()
+            for child in reversed(list(self.walk(node))):
+                if child['name'] in self.ARITHM and all(id(sub) in arithmetic for sub in child.get('children', [])):
+                    arithmetic.add(id(child))
             valuestmts = self.findall(node, 'valueStmt')
             for stmt in valuestmts:
-                classes = self.getallclasses(stmt)
-                if classes.issubset(self.ARITHM):
+                if id(stmt) in arithmetic:
+                    # Nested expressions are replaced along with this one
+                    arithmetic.difference_update(id(sub) for sub in self.walk(stmt))
                     val = None
                     try:
                         val = eval(self.get_text(stmt))
                     except:
                         raise
-                    stmt['children'] = [{'name': 'literal', 'children': [{'name': 'SHORTLITERAL', 'value': str(val)}]}]
+                    stmt['children'] = [Node.build({'name': 'literal', 'children': [{'name': 'SHORTLITERAL', 'value': str(val)}]})]
 
     def clean_whitespaces(self):
         for node in [self.attr, self.decl, self.body]:
             for ws in self.findall(node, 'WS'):
-                ws['value'] = ' '
+                if ws['value'] != ' ':
+                    ws['value'] = ' '
 
     def clean_newlines(self):
         for node in [self.attr, self.decl, self.body]:
             for newline in self.findall(node, 'endOfStatement'):
-                newline.clear()
-                newline.update(self.newline())
+                if not self.is_newline(newline):
+                    children = self.newline()['children']
+                    children[0]['parent'] = newline
+                    newline['children'] = children
 
     def _useless_attr(self, attrst):
-        simple_attr = self.xpath(attrst, ['implicitCallStmt_InStmt', 'iCS_S_VariableOrProcedureCall'])
-        if not simple_attr:
+        simple_attr = self.xpath_first(attrst, ['implicitCallStmt_InStmt', 'iCS_S_VariableOrProcedureCall'])
+        if simple_attr is None:
             return False
-        name = self.identifier_name(simple_attr[0])
+        name = self.identifier_name(simple_attr)
         if name in self.BASE_ATTR:
             return True
         else:
@@ -233,7 +347,14 @@ class Deobfuscator(Parser):
         if isinstance(value, int):
             return {"name": "literal", "children": [{ 'name': 'SHORTLITERAL', 'value': str(value)}]}
         elif isinstance(value, basestring):
-            return {"name": "literal", "children": [ { 'name': 'STRINGLITERAL', 'value': '"{0}"'.format(value.replace('"', '""'))}]}
+            if isinstance(value, bytes):
+                # Literals of the translated code come out as UTF-8, Chr()
+                # gives single bytes
+                try:
+                    value = value.decode('utf-8')
+                except UnicodeDecodeError:
+                    value = value.decode('latin-1')
+            return {"name": "literal", "children": [ { 'name': 'STRINGLITERAL', 'value': u'"{0}"'.format(value.replace('"', '""'))}]}
         elif isinstance(value, list):
             if len(value) > 0:
                 literal_list = [self.__format_value(val) for val in value]
@@ -276,18 +397,29 @@ class Deobfuscator(Parser):
         for proccall in (self.findall(node, 'iCS_B_ProcedureCall') + self.findall(node, 'iCS_S_VariableOrProcedureCall')):
             name = self.identifier_name(proccall)
             if name == proc:
-                translator = Translator(proccall['parent'], known_functions=known_functions, debug=self._debug)
-                if not translator.parsed():
-                    replaced = False
-                    continue
+                self._call_stats['calls'] += 1
+                text = self.get_text(proccall['parent'])
+                code = self._call_codes.get(text)
+                if code is None:
+                    translator = Translator(proccall['parent'], known_functions=known_functions, debug=self._debug)
+                    if not translator.parsed():
+                        replaced = False
+                        continue
+                    code = translator.code()
+                    self._call_codes[text] = code
+                else:
+                    self._call_stats['translations'] += 1
                 try:
-                    value = self._interpretor.eval(str(translator), {})
-                except NotImplementedError as e:
-                    self.debug(str(e))
-                    replaced = False
-                    continue
-                except Exception as e:
-                    self.debug(str(e))
+                    (value, error) = self._call_values[(proc, code)]
+                    self._call_stats['values'] += 1
+                except KeyError:
+                    try:
+                        (value, error) = (self._interpretor.eval(code, {}), None)
+                    except Exception as e:
+                        (value, error) = (None, str(e))
+                    self._call_values[(proc, code)] = (value, error)
+                if error is not None:
+                    self.debug(error)
                     replaced = False
                     continue
                 try:
@@ -309,7 +441,8 @@ class Deobfuscator(Parser):
                 self.debug("With:")
                 self.debug(str(value), ident=2)
                 self.debug("\n")
-                parent['children'] = [newval]
+                parent['children'] = [Node.build(newval)]
+        self._touched(node)
         return replaced
 
     def _clean_up_function(self, touched, proc_dep, reverse_dep):
@@ -334,42 +467,125 @@ class Deobfuscator(Parser):
                     else:
                         self.debug('Not removing {0}, still used by ({1}): {2}'.format(proc, len(reverse_dep[proc]), ', '.join(reverse_dep[proc])))
 
+    @classmethod
+    def _cache_key(cls, kind, data):
+        if Deobfuscator._translator_version is None:
+            with open(inspect.getsourcefile(Translator), 'rb') as f:
+                Deobfuscator._translator_version = hashlib.sha256(f.read()).hexdigest()
+        key = hashlib.sha256(Deobfuscator._translator_version.encode('ascii'))
+        key.update(MAGIC_NUMBER)
+        key.update(kind)
+        key.update(data if isinstance(data, bytes) else data.encode('utf-8'))
+        return key.hexdigest()
+
+    def _canonical(self, node):
+        # The identifiers of node by order of appearance, and its text with
+        # them numbered instead: the same procedure gets the same text
+        # whatever clean_ids called things
+        names = []
+        numbers = {}
+        text = []
+        for child in self.walk(node):
+            if 'value' not in child or child['name'] == 'EOF':
+                continue
+            value = child['value']
+            if child['name'] == 'IDENTIFIER' and value not in PROC_OK:
+                if value not in numbers:
+                    numbers[value] = len(names)
+                    names.append(value)
+                value = '_c{0}_'.format(numbers[value])
+            elif self.CANONICAL.search(value):
+                return (None, None)
+            text.append(value)
+        return (names, ''.join(text))
+
+    def _translate(self, proc, known_functions):
+        # Translator output for proc and its compiled code, or (None, None)
+        node = self._proc[proc]
+        (names, text) = (None, None)
+        if self.CACHE is not None:
+            (names, text) = self._canonical(node)
+        if names is None:
+            translator = Translator(node, known_functions=known_functions, debug=self._debug)
+            if not translator.parsed():
+                return (None, None)
+            code = translator.code()
+            return (code, Interpretor.compile(code))
+        # Whether its callees were translated matters too
+        known = ''.join('1' if name in known_functions else '0' for name in names)
+        key = self._cache_key(b'translation', u'{0}\n{1}'.format(known, text))
+        data = self.CACHE.get(key)
+        if data is None:
+            numbers = dict((name, index) for (index, name) in enumerate(names))
+            canonical = Node.loads(node.dumps())
+            for child in self.walk(canonical):
+                if child['name'] == 'IDENTIFIER' and child['value'] not in PROC_OK:
+                    child['value'] = '_c{0}_'.format(numbers[child['value']])
+            known = ['_c{0}_'.format(index) for (index, name) in enumerate(names) if name in known_functions]
+            translator = Translator(canonical, known_functions=known, debug=self._debug)
+            code = translator.code() if translator.parsed() else None
+            self.CACHE.put(key, marshal.dumps(code))
+        else:
+            code = marshal.loads(data)
+        if code is None:
+            return (None, None)
+        code = self.CANONICAL.sub(lambda match: names[int(match.group(1))], code)
+        key = self._cache_key(b'code', code)
+        data = self.CACHE.get(key)
+        if data is None:
+            compiled = Interpretor.compile(code)
+            self.CACHE.put(key, marshal.dumps(compiled))
+        else:
+            compiled = marshal.loads(data)
+        return (code, compiled)
+
     def clean_resolvable(self):
         (proc_dep, reverse_dep, _) = self._build_deps()
-        done = False
+        calls = dict((proc, [dep for dep in proc_dep[proc] if dep in proc_dep and dep not in PROC_OK])
+                     for proc in proc_dep)
+        # Depending on something that will never be resolved
+        blocked = set(proc for proc in proc_dep
+                      if any(dep not in PROC_OK and dep not in proc_dep for dep in proc_dep[proc]))
         non_translatable = set()
         translated = set()
-        while not done:
-            done = True
-            good = set(list(PROC_OK) + list(non_translatable) + list(translated))
-            for proc in proc_dep:
-                if proc in non_translatable or proc in translated:
-                    continue
-                if proc_dep[proc].issubset(good):
-                    translator = Translator(self._proc[proc], known_functions=translated, debug=self._debug)
-                    if not translator.parsed():
-                        self.debug("Can't translate {0}".format(proc))
-                        non_translatable.add(proc)
-                        continue
-                    code = str(translator)
-                    self.debug("Emulating:")
-                    self.debug(self.get_text(self._proc[proc]), ident=2)
-                    self.debug("With:")
-                    self.debug(code, ident=2)
-                    self.debug("\n")
-                    done = False
-                    self._interpretor.add_fun(proc, code)
-                    translated.add(proc)
-                    if proc in reverse_dep:
-                        for caller in list(reverse_dep[proc]):
-                            if self._replace_call(proc, self._proc[caller], translated):
-                                reverse_dep[proc].remove(caller)
+        for group in CallGraph.schedule(calls, list(proc_dep)):
+            if any(proc in blocked or not blocked.isdisjoint(calls[proc]) for proc in group):
+                blocked.update(group)
+                continue
+            if len(group) > 1:
+                self.debug("Can't translate {0}: recursive".format(', '.join(group)))
+                non_translatable.update(group)
+                continue
+            proc = group[0]
+            (code, compiled) = self._translate(proc, translated)
+            if code is None:
+                self.debug("Can't translate {0}".format(proc))
+                non_translatable.add(proc)
+                continue
+            self.debug("Emulating:")
+            self.debug(self.get_text(self._proc[proc]), ident=2)
+            self.debug("With:")
+            self.debug(code, ident=2)
+            self.debug("\n")
+            if proc in self._emulated:
+                # Values computed with the previous version are stale
+                self._call_values.clear()
+            self._emulated.add(proc)
+            self._interpretor.add_compiled(proc, compiled)
+            translated.add(proc)
+            if proc in reverse_dep:
+                for caller in list(reverse_dep[proc]):
+                    if self._replace_call(proc, self._proc[caller], translated):
+                        reverse_dep[proc].remove(caller)
         for proc in translated:
             if proc in reverse_dep:
                 for caller in list(reverse_dep[proc]):
                     if self._replace_call(proc, self._proc[caller], translated):
                         reverse_dep[proc].remove(caller)
         self._clean_up_function(translated, proc_dep, reverse_dep)
+        stats = self._call_stats
+        self.debug('Emulated {0} call sites, reused {1} translations and {2} values ({3}% hits)'.format(
+            stats['calls'], stats['translations'], stats['values'], 100 * stats['values'] // max(stats['calls'], 1)))
         self.debug('Unsolved dependencies:')
         for proc in proc_dep:
             if proc not in translated:
@@ -377,16 +593,32 @@ class Deobfuscator(Parser):
 
     def _inline_function(self, proc_name, block, target_name):
         proc = self._proc[proc_name]
-        if self.proc_arguments(proc):
+        callee = Dataflow.of(proc)
+        if callee.arguments:
             self.debug('Cannot inline {0} in {1}: arguments required'.format(proc_name, target_name))
             return False
+        caller = Dataflow.of(self._proc[target_name])
+        # Pasted in the caller, the variables of the callee resolve there: one
+        # it does not declare (a global) must not hit a Dim of the caller, one
+        # it declares must not hit a caller variable whose value it would
+        # start from (read before being set) or clobber (live after the call)
+        clash = (callee.upward_exposed() | callee.defined()) - callee.declared()
+        clash &= caller.declared()
+        shared = callee.declared() & caller.identifiers
+        if shared:
+            clash |= shared & (callee.uninitialized() | caller.live_after(block['children'][0]))
+        if clash:
+            self.debug('Cannot inline {0} in {1}: conflicting variables {2}'.format(proc_name, target_name,
+                                                                                    ', '.join(sorted(clash))))
+            return False
         proc_block = self.xpath(proc, ['block'])
         if len(proc_block) != 1:
             self.debug('Cannot inline {0} in {1}: invalid function (more than one block)'.format(proc_name, target_name))
             return False
         proc_blocks = proc_block[0]['children']
         while proc_blocks[-1]['name'] == 'endOfStatement':
-            proc_blocks.pop()
+            proc_blocks = proc_blocks[:-1]
+        proc_block[0]['children'] = proc_blocks
         self.debug('Inlining {0} in {1}'.format(proc_name, target_name))
         parent = block['parent']
         del block['parent']
@@ -395,6 +627,7 @@ class Deobfuscator(Parser):
         for child in new_children:
             child['parent'] = parent
         parent['children'] = parent['children'][:index] + new_children + parent['children'][(index + 1):]
+        self._touched(parent)
         return True
 
     def _is_simple_callout(self, node):
@@ -406,34 +639,69 @@ class Deobfuscator(Parser):
 
     def inline_functions(self):
         (proc_dep, reverse_dep, _) = self._build_deps()
-        work_deps = copy.deepcopy(proc_dep)
-        for caller in work_deps:
-            work_deps[caller] = [callee for callee in work_deps[caller] if callee in self._proc]
-        todo = list(self._proc)
+        calls = dict((caller, [callee for callee in proc_dep[caller] if callee in self._proc])
+                     for caller in proc_dep)
         inlined = set()
-        while todo:
-            for proc in list(todo):
-                if proc not in work_deps or not work_deps[proc]:
-                    blocks = self.findall(self._proc[proc], 'blockStmt')
-                    for block in blocks:
-                        callout = self._is_simple_callout(block)
-                        if (not callout) or callout not in self._proc:
-                            continue
-                        if self._inline_function(callout, block, proc):
-                            inlined.add(callout)
-                    todo.remove(proc)
-                    if proc in reverse_dep:
-                        for caller in reverse_dep[proc]:
-                            work_deps[caller].remove(proc)
+        # Callees first, recursive procedures together
+        for group in CallGraph.schedule(calls, list(self._proc)):
+            for proc in group:
+                blocks = self.findall(self._proc[proc], 'blockStmt')
+                for block in blocks:
+                    callout = self._is_simple_callout(block)
+                    if (not callout) or callout not in self._proc:
+                        continue
+                    if callout != proc and callout in group:
+                        self.debug('Cannot inline {0} in {1}: recursive'.format(callout, proc))
+                        continue
+                    if self._inline_function(callout, block, proc):
+                        inlined.add(callout)
         (_, new_reverse_dep, _) = self._build_deps()
         for proc in reverse_dep:
             if proc not in new_reverse_dep:
                 reverse_dep[proc] = set([])
         self._clean_up_function(inlined, proc_dep, reverse_dep)
 
+    @classmethod
+    def _get_emulation_pool(cls):
+        if Deobfuscator._emulation_pool is None:
+            Deobfuscator._emulation_pool = EmulationPool(cls.EMULATION_WORKERS, cpu=cls.EMULATION_CPU,
+                                                         memory=cls.EMULATION_MEMORY, timeout=cls.EMULATION_TIMEOUT)
+            atexit.register(Deobfuscator._emulation_pool.close)
+        return Deobfuscator._emulation_pool
+
+    @classmethod
+    def _get_clean_pool(cls):
+        if Deobfuscator._clean_pool is None:
+            Deobfuscator._clean_pool = multiprocessing.Pool(cls.CLEAN_PROCESSES)
+            atexit.register(Deobfuscator._clean_pool.terminate)
+        return Deobfuscator._clean_pool
+
     def clean_functions(self):
-        for proc in self._proc:
+        procs = list(self._proc)
+        if self.CLEAN_PROCESSES > 1 and len(procs) > 1 and multiprocessing.cpu_count() > 1:
+            data = [self._proc[proc].dumps() for proc in procs]
+            sizes = [len(proc_data) for proc_data in data]
+            if sum(sizes) - max(sizes) >= self.CLEAN_POOL_MIN_BYTES:
+                jobs = [(proc_data, proc, list(self._var), self._debug) for (proc_data, proc) in zip(data, procs)]
+                for (proc, (changes, output)) in zip(procs, self._get_clean_pool().map(_clean_procedure, jobs)):
+                    sys.stdout.write(output)
+                    nodes = list(self.walk(self._proc[proc]))
+                    for (position, children) in changes:
+                        node = nodes[position]
+                        old = node.get('children', [])
+                        new = []
+                        for child in children:
+                            if isinstance(child, int):
+                                new.append(old[child])
+                            else:
+                                new.append(Node.loads(child))
+                                new[-1]['parent'] = node
+                        node['children'] = new
+                    self._touched(self._proc[proc])
+                return
+        for proc in procs:
             Cleaner(known_var=self._var, debug=self._debug).clean(self._proc[proc], proc)
+            self._touched(self._proc[proc])
 
 if __name__ == '__main__':
     import sys
@@ -7,6 +7,14 @@
 
 from __future__ import print_function
 
+import marshal
+import multiprocessing
+import resource
+import signal
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
 
 UNKNOWN_METHOD_CALL='''
 def method_call(obj, meth, args):
@@ -130,7 +138,15 @@ class Interpretor(object):
         self._globals['Error_description'] = False
 
 
+    @classmethod
+    def compile(cls, code):
+        return compile(code, '<string>', 'exec')
+
     def add_fun(self, name, code):
+        self.add_compiled(name, self.compile(code))
+
+    def add_compiled(self, name, code):
+        # code: compiled translator output defining name
         self._reset_errors()
         tmp_locals = {}
         exec(code, self._globals, tmp_locals)
@@ -139,3 +155,153 @@ class Interpretor(object):
     def eval(self, code, known_locals):
         self._reset_errors()
         return eval(code, self._globals, known_locals)
+
+
+class EmulationError(ValueError):
+    pass
+
+class EmulationTimeout(EmulationError):
+    pass
+
+def _cpu_exceeded(signum, frame):
+    raise EmulationTimeout('Emulation CPU time limit exceeded')
+
+def _address_space():
+    # Size of the address space of this process, in bytes
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[0]) * resource.getpagesize()
+    except (IOError, OSError, ValueError, IndexError):
+        return 0
+
+def _emulation_worker(connection, cpu, memory):
+    # Main loop of a worker process, where the limits apply. Requests are
+    # (start, definitions, code, known_locals): the definitions of the
+    # functions from the start-th one, 0 for a new Interpretor, then the
+    # code to evaluate.
+    if memory:
+        # On top of what was inherited from the parent, whatever its size
+        # when the worker was forked
+        limit = _address_space() + memory
+        (_, hard) = resource.getrlimit(resource.RLIMIT_AS)
+        if hard != resource.RLIM_INFINITY:
+            limit = min(limit, hard)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    signal.signal(signal.SIGXCPU, _cpu_exceeded)
+    (_, hard) = resource.getrlimit(resource.RLIMIT_CPU)
+    interpretor = None
+    while True:
+        try:
+            (start, definitions, code, known_locals) = connection.recv()
+        except EOFError:
+            return
+        try:
+            if cpu:
+                # The limit is on the CPU time used so far
+                used = int(sum(resource.getrusage(resource.RUSAGE_SELF)[:2])) + cpu + 1
+                resource.setrlimit(resource.RLIMIT_CPU, (used if hard == resource.RLIM_INFINITY else min(used, hard), hard))
+            if start == 0:
+                interpretor = Interpretor()
+            for (name, data) in definitions:
+                interpretor.add_compiled(name, marshal.loads(data))
+            answer = (None, interpretor.eval(code, known_locals))
+        except Exception as e:
+            answer = (type(e).__name__, str(e) or type(e).__name__)
+        try:
+            connection.send(answer)
+        except Exception as e:
+            connection.send(('EmulationError', 'Unable to send the result back: {0}'.format(e)))
+
+class EmulationWorker(object):
+
+    def __init__(self, cpu=None, memory=None, timeout=None):
+        self._cpu = cpu
+        self._memory = memory
+        self._timeout = timeout
+        self._process = None
+        self._connection = None
+        # The PooledInterpretor whose functions the worker has, and how many
+        self._owner = None
+        self._defined = 0
+
+    def start(self):
+        self.stop()
+        (self._connection, child) = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=_emulation_worker, args=(child, self._cpu, self._memory))
+        self._process.daemon = True
+        self._process.start()
+        child.close()
+
+    def stop(self):
+        if self._process is None:
+            return
+        self._connection.close()
+        self._process.terminate()
+        self._process.join()
+        self._process = None
+        self._owner = None
+
+    def eval(self, owner, definitions, code, known_locals):
+        if self._process is None or not self._process.is_alive():
+            self.start()
+        start = self._defined if self._owner is owner else 0
+        try:
+            self._connection.send((start, definitions[start:], code, known_locals))
+            if not self._connection.poll(self._timeout):
+                # Whatever it is doing, it won't answer in time
+                self.stop()
+                raise EmulationTimeout('Emulation timeout')
+            (error, answer) = self._connection.recv()
+        except (EOFError, IOError, OSError):
+            self.stop()
+            raise EmulationError('Emulation worker died')
+        if error is None:
+            (self._owner, self._defined) = (owner, len(definitions))
+            return answer
+        # The definitions may not all have gone through
+        self._owner = None
+        if error == 'NotImplementedError':
+            raise NotImplementedError(answer)
+        if error == 'EmulationTimeout':
+            raise EmulationTimeout(answer)
+        raise EmulationError(answer)
+
+class EmulationPool(object):
+    # Workers forked in advance, and reused: emulating then costs a round
+    # trip through a pipe
+
+    def __init__(self, size, cpu=None, memory=None, timeout=None):
+        self._workers = [EmulationWorker(cpu=cpu, memory=memory, timeout=timeout) for _ in range(size)]
+        self._idle = Queue()
+        for worker in self._workers:
+            worker.start()
+            self._idle.put(worker)
+
+    def eval(self, owner, definitions, code, known_locals):
+        worker = self._idle.get()
+        try:
+            return worker.eval(owner, definitions, code, known_locals)
+        finally:
+            self._idle.put(worker)
+
+    def close(self):
+        for worker in self._workers:
+            worker.stop()
+
+class PooledInterpretor(object):
+    # Same as Interpretor, running the translated code in an EmulationPool:
+    # a timeout or a limit reached is an error like any other
+
+    def __init__(self, pool):
+        self._pool = pool
+        # (name, marshalled code), in the order they were added
+        self._definitions = []
+
+    def add_fun(self, name, code):
+        self.add_compiled(name, Interpretor.compile(code))
+
+    def add_compiled(self, name, code):
+        self._definitions.append((name, marshal.dumps(code)))
+
+    def eval(self, code, known_locals):
+        return self._pool.eval(self, self._definitions, code, known_locals)
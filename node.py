@@ -0,0 +1,396 @@
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+from __future__ import print_function
+
+from bisect import bisect_left, bisect_right
+import marshal
+
+class Node(object):
+    # Behaves like the {'name', 'value', 'children', 'parent'} dicts the
+    # passes were written for: a missing key is an unset slot
+    KEYS = ('name', 'value', 'children', 'parent')
+    # Position in the NodeIndex of the tree, if any
+    __slots__ = KEYS + ('pre', 'post', 'index')
+    loaded = True
+
+    def __init__(self, name, value=None, children=None):
+        self.name = name
+        if value is not None:
+            self.value = value
+        if children is not None:
+            self.children = children
+
+    @classmethod
+    def build(cls, tree):
+        if isinstance(tree, Node):
+            return tree
+        root = cls(tree['name'], tree.get('value'))
+        stack = [(tree, root)]
+        while stack:
+            (tree, node) = stack.pop()
+            if 'children' in tree:
+                node.children = []
+                for child in tree['children']:
+                    if not isinstance(child, Node):
+                        copy = cls(child['name'], child.get('value'))
+                        stack.append((child, copy))
+                        child = copy
+                    node.children.append(child)
+            if 'parent' in tree:
+                node.parent = tree['parent']
+        return root
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.KEYS:
+            raise KeyError(key)
+        old = getattr(self, key, None)
+        setattr(self, key, value)
+        self._changed(key, old, value)
+
+    def __delitem__(self, key):
+        old = getattr(self, key, None)
+        try:
+            delattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+        self._changed(key, old, None)
+
+    def _changed(self, key, old, new):
+        index = getattr(self, 'index', None)
+        if index is None:
+            return
+        index.invalidate(self)
+        if key == 'children':
+            index.replace_children(self, old or [], new or [])
+        elif key == 'name':
+            index.rename(self, old, new)
+
+    def __contains__(self, key):
+        return key in self.KEYS and hasattr(self, key)
+
+    def get(self, key, default=None):
+        if key in self.KEYS:
+            return getattr(self, key, default)
+        return default
+
+    def keys(self):
+        return [key for key in self.KEYS if hasattr(self, key)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def clear(self):
+        for key in self.keys():
+            del self[key]
+
+    def update(self, other):
+        for key in other.keys():
+            self[key] = other[key]
+
+    def __deepcopy__(self, memo):
+        # Only copy downwards: the copy keeps pointing to the original
+        # parent unless that parent is being copied as well
+        root = memo[id(self)] = Node(self.name)
+        stack = [(self, root)]
+        while stack:
+            (node, copy) = stack.pop()
+            if hasattr(node, 'value'):
+                copy.value = node.value
+            if hasattr(node, 'children'):
+                copy.children = []
+                for child in node.children:
+                    if id(child) not in memo:
+                        memo[id(child)] = Node(child.name)
+                        stack.append((child, memo[id(child)]))
+                    copy.children.append(memo[id(child)])
+            # Ancestors within the copy are always copied first
+            if hasattr(node, 'parent'):
+                copy.parent = memo.get(id(node.parent), node.parent)
+        return root
+
+    def dumps(self):
+        # The subtree without its parent links, to be sent to another
+        # process: the names, the values, and per node in pre-order the
+        # index of its name, of its value (or -1) and its number of
+        # children (or -1 without a children list)
+        names = {}
+        values = []
+        records = []
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            records.append(names.setdefault(node.name, len(names)))
+            if hasattr(node, 'value'):
+                records.append(len(values))
+                values.append(node.value)
+            else:
+                records.append(-1)
+            children = getattr(node, 'children', None)
+            if children is None:
+                records.append(-1)
+            else:
+                records.append(len(children))
+                stack.extend(reversed(children))
+        return marshal.dumps((sorted(names, key=names.get), values, records))
+
+    @classmethod
+    def loads(cls, data):
+        (names, values, records) = marshal.loads(data)
+        root = None
+        stack = []
+        for position in range(0, len(records), 3):
+            node = cls(names[records[position]])
+            if records[position + 1] >= 0:
+                node.value = values[records[position + 1]]
+            count = records[position + 2]
+            if count >= 0:
+                node.children = []
+            if stack:
+                top = stack[-1]
+                top[0].children.append(node)
+                node.parent = top[0]
+                top[1] -= 1
+            else:
+                root = node
+            if count > 0:
+                stack.append([node, count])
+            else:
+                while stack and not stack[-1][1]:
+                    stack.pop()
+        return root
+
+    def __repr__(self):
+        if hasattr(self, 'value'):
+            return 'Node({0!r}, {1!r})'.format(self.name, self.value)
+        return 'Node({0!r})'.format(self.name)
+
+class LazyNode(Node):
+    # A subtree only built once something looks into its children: the
+    # names and identifiers found below it are known beforehand (and are
+    # not kept up to date once it is loaded)
+    __slots__ = ('_loader', 'names', 'identifiers')
+
+    def __init__(self, name, loader, names, identifiers):
+        Node.__init__(self, name)
+        self._loader = loader
+        self.names = names
+        self.identifiers = identifiers
+
+    @property
+    def loaded(self):
+        return self._loader is None
+
+    def load(self):
+        if self._loader is None:
+            return
+        loader = self._loader
+        self._loader = None
+        loader(self)
+        index = getattr(self, 'index', None)
+        if index is not None:
+            index.loaded(self)
+
+    def __getattr__(self, key):
+        # Only called for unset slots
+        if key != 'children' or self._loader is None:
+            raise AttributeError(key)
+        self.load()
+        return self.children
+
+class NodeIndex(object):
+    # Name -> nodes index over trees, in document order. Every indexed node
+    # gets a pre and post position, a descendant being strictly between the
+    # positions of its ancestors, so the nodes of a subtree with a given
+    # name are a slice of the sorted per name list. Replaced subtrees are
+    # renumbered in the gap they leave, the whole index is only rebuilt
+    # once the gaps get too small. LazyNodes are indexed without their
+    # subtree, which is added once loaded.
+    # The cache holds what was computed from a subtree, until it changes.
+    MIN_STEP = 1e-6
+
+    def __init__(self, roots):
+        self._roots = roots
+        self.cache = {}
+        # Cache key -> root of the subtree it was computed from
+        self._owners = {}
+        self._build()
+
+    def store(self, key, owner, value):
+        self.cache[key] = value
+        self._owners[key] = owner
+        return value
+
+    def invalidate(self, node):
+        # Forget what was computed from a subtree holding node, or from one
+        # node holds (it may be replaced), or from one no longer indexed
+        for (key, owner) in list(self._owners.items()):
+            if (getattr(owner, 'index', None) is not self or owner.pre <= node.pre <= owner.post or
+                    node.pre <= owner.pre <= node.post):
+                del self.cache[key]
+                del self._owners[key]
+
+    @classmethod
+    def _events(cls, nodes):
+        stack = [(node, True) for node in reversed(nodes)]
+        while stack:
+            (node, enter) = stack.pop()
+            yield (node, enter)
+            if enter:
+                stack.append((node, False))
+                if node.loaded and hasattr(node, 'children'):
+                    stack.extend((child, True) for child in reversed(node.children))
+
+    def _build(self):
+        self._names = {}
+        self._pending = ([], [])
+        position = 0
+        for (node, enter) in self._events(self._roots):
+            position += 1
+            if enter:
+                node.pre = position
+                node.index = self
+                try:
+                    entry = self._names[node.name]
+                except KeyError:
+                    entry = self._names[node.name] = ([], [])
+                entry[0].append(position)
+                entry[1].append(node)
+                if not node.loaded:
+                    self._pending[0].append(position)
+                    self._pending[1].append(node)
+            else:
+                node.post = position
+
+    @classmethod
+    def _insert(cls, entry, low, positions, nodes):
+        start = bisect_right(entry[0], low)
+        entry[0][start:start] = positions
+        entry[1][start:start] = nodes
+
+    def _add(self, nodes, low, high):
+        for node in nodes:
+            # Subtree moved from somewhere else in the tree
+            if getattr(node, 'index', None) is self:
+                self._remove(node)
+        events = list(self._events(nodes))
+        step = float(high - low) / (len(events) + 1)
+        if step < self.MIN_STEP:
+            return False
+        added = {}
+        pending = ([], [])
+        position = low
+        for (node, enter) in events:
+            position += step
+            if enter:
+                node.pre = position
+                node.index = self
+                try:
+                    entry = added[node.name]
+                except KeyError:
+                    entry = added[node.name] = ([], [])
+                entry[0].append(position)
+                entry[1].append(node)
+                if not node.loaded:
+                    pending[0].append(position)
+                    pending[1].append(node)
+            else:
+                node.post = position
+        for (name, (positions, nodes)) in added.items():
+            try:
+                entry = self._names[name]
+            except KeyError:
+                entry = self._names[name] = ([], [])
+            self._insert(entry, low, positions, nodes)
+        self._insert(self._pending, low, pending[0], pending[1])
+        return True
+
+    def _remove(self, node):
+        names = set()
+        for (child, enter) in self._events([node]):
+            if enter:
+                names.add(child.name)
+                del child.index
+        for entry in [self._names[name] for name in names] + [self._pending]:
+            (positions, nodes) = entry
+            start = bisect_left(positions, node.pre)
+            end = bisect_right(positions, node.post)
+            del positions[start:end]
+            del nodes[start:end]
+
+    def _attached(self, node, parent):
+        return getattr(node, 'index', None) is self and parent.pre < node.pre < parent.post
+
+    def replace_children(self, parent, old, new):
+        old_ids = set(id(child) for child in old)
+        new_ids = set(id(child) for child in new)
+        for child in old:
+            if id(child) not in new_ids and self._attached(child, parent):
+                self._remove(child)
+        kept = [child for child in new if id(child) in old_ids]
+        if kept != [child for child in old if id(child) in new_ids]:
+            for child in kept:
+                self._remove(child)
+            old_ids = set()
+        low = parent.pre
+        added = []
+        for child in new:
+            if id(child) in old_ids:
+                if added and not self._add(added, low, child.pre):
+                    return self._build()
+                added = []
+                low = child.post
+            else:
+                added.append(child)
+        if added and not self._add(added, low, parent.post):
+            self._build()
+
+    def rename(self, node, old, new):
+        if old is not None:
+            (positions, nodes) = self._names[old]
+            position = bisect_left(positions, node.pre)
+            del positions[position]
+            del nodes[position]
+        if new is not None:
+            try:
+                (positions, nodes) = self._names[new]
+            except KeyError:
+                (positions, nodes) = self._names[new] = ([], [])
+            position = bisect_left(positions, node.pre)
+            positions.insert(position, node.pre)
+            nodes.insert(position, node)
+
+    def loaded(self, node):
+        (positions, nodes) = self._pending
+        position = bisect_left(positions, node.pre)
+        del positions[position]
+        del nodes[position]
+        self.replace_children(node, [], node.children)
+
+    def pending(self, node):
+        (positions, nodes) = self._pending
+        return nodes[bisect_left(positions, node.pre):bisect_right(positions, node.post)]
+
+    def findall(self, node, name, load=True):
+        if load:
+            for lazy in self.pending(node):
+                if name in lazy.names:
+                    lazy.load()
+        try:
+            (positions, nodes) = self._names[name]
+        except KeyError:
+            return []
+        return nodes[bisect_left(positions, node.pre):bisect_right(positions, node.post)]
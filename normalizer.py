@@ -0,0 +1,80 @@
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+from __future__ import print_function
+
+import re
+
+WORD_CHAR = u'[^\\[\\]()\r\n\t.,\'"|!@#$%^&*\\-+:=; ]'
+
+class Normalizer(object):
+    # Comments and Rem lines are dropped, blanks and line continuations
+    # collapsed: the parsed text, and so the decoded one, has no comments.
+    # Same token boundaries as the lexer (parser/vba.g4), so that strings
+    # and [bracketed identifiers] are kept verbatim
+    TOKENS = re.compile(u'|'.join([
+        u'(?P<string>"(?:[^"\r\n]|"")*")',
+        u'(?P<bracket>\\[[^!\\]\r\n]+\\])',
+        u'(?P<comment>\'(?:[ \t]+_\r?\n|[^\r\n\u2028\u2029])*)',
+        u'(?P<ws>(?:[ \t]+_\r?\n|[ \t])+)',
+        u'(?P<newline>[\r\n\u2028\u2029]+)',
+        u'(?P<word>{0}+)'.format(WORD_CHAR),
+        u'(?P<other>.)',
+    ]), re.DOTALL)
+    REM = re.compile(u'[ \t](?:[ \t]+_\r?\n|[^\r\n\u2028\u2029])*')
+    # A lone continuation is skipped by the lexer, anything longer is WS.
+    # Still keep words apart.
+    CONTINUATION = re.compile(u'[ \t]+_\r?\n\\Z')
+    WORD = re.compile(WORD_CHAR)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.processed = 0
+        self.removed = 0
+
+    def normalize(self, data):
+        if isinstance(data, bytes):
+            # One character per byte, and back
+            return self.normalize(data.decode('latin-1')).encode('latin-1')
+        out = []
+        position = 0
+        while position < len(data):
+            match = self.TOKENS.match(data, position)
+            kind = match.lastgroup
+            text = match.group(kind)
+            position = match.end()
+            if kind == 'comment':
+                continue
+            if kind == 'word' and text.lower() == 'rem':
+                rem = self.REM.match(data, position)
+                if rem is not None:
+                    position = rem.end()
+                    continue
+            if kind == 'ws':
+                if not out or out[-1] == '\n':
+                    continue
+                if (self.CONTINUATION.match(text) and
+                        not (self.WORD.match(out[-1][-1]) and self.WORD.match(data, position))):
+                    continue
+                text = ' '
+            elif kind == 'newline':
+                if out and out[-1] == ' ':
+                    out.pop()
+                if not out or out[-1] == '\n':
+                    continue
+                text = '\n'
+            out.append(text)
+        normalized = ''.join(out)
+        self.processed += len(data)
+        self.removed += len(data) - len(normalized)
+        return normalized
+
+    def stats(self):
+        return '{0} bytes removed out of {1} ({2:.0%})'.format(self.removed, self.processed,
+                                                              float(self.removed) / self.processed if self.processed else 0)
@@ -7,83 +7,602 @@
 
 from __future__ import print_function
 
-from copy import deepcopy
+from array import array
+import atexit
+import gc
+import hashlib
 import inspect
 import json
+import os
 import os.path
+from select import select
+import struct
 from subprocess import Popen, PIPE
 import sys
+from threading import Lock
+import time
+
+from node import LazyNode, Node, NodeIndex
+from normalizer import Normalizer
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+class ParseTimeout(ValueError):
+    pass
+
+class TreeDecoder(object):
+    # Builds the nodes of a BinaryTree answer while it is being read: the
+    # string pool and the procedure chunks come first, then the pre-order
+    # records are decoded by chunks, each node being linked to its parent
+    # as it is created. In lazy mode the procedure blocks are LazyNodes,
+    # built from the kept records once something looks into them.
+
+    def __init__(self, names, keep=False, lazy=False):
+        self._names = names
+        self._buffer = bytearray()
+        self._values = None
+        self._remaining = None
+        # Procedure chunks still ahead, the next one last
+        self._chunks = []
+        # Records received, and the next one to build
+        self._received = 0
+        self._position = 0
+        self._records = array('i') if lazy else None
+        # The nodes still missing children, with how many they miss
+        self._stack = []
+        self.root = None
+        self.data = [] if keep else None
+
+    @classmethod
+    def _ints(cls, data, offset, count):
+        ints = array('i')
+        try:
+            ints.frombytes(data[offset:offset + 4 * count])
+        except AttributeError:
+            ints.fromstring(data[offset:offset + 4 * count])
+        if sys.byteorder == 'little':
+            ints.byteswap()
+        return ints
+
+    @classmethod
+    def decode(cls, names, data, lazy=False):
+        decoder = cls(names, lazy=lazy)
+        decoder.feed(data)
+        return decoder.close()
+
+    def _header(self):
+        data = self._buffer
+        try:
+            (count,) = struct.unpack_from('>i', data, 0)
+            ends = struct.unpack_from('>{0}i'.format(count), data, 4)
+            offset = 4 + 4 * count
+            (length,) = struct.unpack_from('>i', data, offset)
+            pool = bytes(data[offset + 4:offset + 4 + length])
+            offset += 4 + length
+            (count,) = struct.unpack_from('>i', data, offset)
+            offset += 4
+            chunks = []
+            for _ in range(count):
+                (start, end, count) = struct.unpack_from('>3i', data, offset)
+                names = struct.unpack_from('>{0}i'.format(count), data, offset + 12)
+                offset += 12 + 4 * count
+                (count,) = struct.unpack_from('>i', data, offset)
+                identifiers = struct.unpack_from('>{0}i'.format(count), data, offset + 4)
+                offset += 4 + 4 * count
+                chunks.append((start, end, names, identifiers))
+            (remaining,) = struct.unpack_from('>i', data, offset)
+        except struct.error:
+            return False
+        starts = [0]
+        starts.extend(ends[:-1])
+        text = pool.decode('utf-8')
+        if len(text) == len(pool):
+            # Pure ASCII: byte offsets are character offsets
+            self._values = [text[start:end] for start, end in zip(starts, ends)]
+        else:
+            self._values = [pool[start:end].decode('utf-8') for start, end in zip(starts, ends)]
+        if self._records is not None:
+            self._chunks = [(start, end, frozenset(self._names[name] for name in names),
+                             frozenset(self._values[value] for value in identifiers))
+                            for (start, end, names, identifiers) in reversed(chunks)]
+        self._remaining = remaining
+        del data[:offset + 4]
+        return True
+
+    def _build(self, records, stack):
+        # Returns the root, if it is one of the records
+        root = None
+        names = self._names
+        values = self._values
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for name, children, value in zip([names[i] for i in records[0::3]], records[1::3], records[2::3]):
+                if value >= 0:
+                    node = Node(name, values[value])
+                elif children:
+                    node = Node(name, children=[])
+                else:
+                    node = Node(name)
+                if stack:
+                    top = stack[-1]
+                    top[0].children.append(node)
+                    node.parent = top[0]
+                    top[1] -= 1
+                else:
+                    root = node
+                if children:
+                    stack.append([node, children])
+                else:
+                    while stack and not stack[-1][1]:
+                        stack.pop()
+        finally:
+            if gc_enabled:
+                gc.enable()
+        return root
+
+    def _loader(self, start, end):
+        def load(node):
+            records = self._records
+            node.children = []
+            self._build(records[3 * start + 3:3 * end], [[node, records[3 * start + 1]]])
+        return load
+
+    def feed(self, data):
+        if self.data is not None:
+            self.data.append(data)
+        self._buffer.extend(data)
+        if self._remaining is None and not self._header():
+            return
+        count = min(len(self._buffer) // 12, self._remaining)
+        if not count:
+            return
+        records = self._ints(bytes(self._buffer[:12 * count]), 0, 3 * count)
+        del self._buffer[:12 * count]
+        self._remaining -= count
+        base = self._received
+        self._received += count
+        if self._records is not None:
+            self._records.extend(records)
+            (records, base) = (self._records, 0)
+        stack = self._stack
+        while self._position < self._received:
+            start = self._position
+            stop = self._received
+            if self._chunks:
+                stop = min(stop, self._chunks[-1][0])
+            if start < stop:
+                root = self._build(records[3 * (start - base):3 * (stop - base)], stack)
+                if root is not None:
+                    self.root = root
+                self._position = stop
+                continue
+            # A procedure block: skipped until needed
+            (_, end, names, identifiers) = self._chunks.pop()
+            node = LazyNode(self._names[records[3 * (start - base)]], self._loader(start, end),
+                            names, identifiers)
+            top = stack[-1]
+            top[0].children.append(node)
+            node.parent = top[0]
+            top[1] -= 1
+            while stack and not stack[-1][1]:
+                stack.pop()
+            self._position = end
+
+    def close(self):
+        if self._remaining != 0 or self._stack or self._buffer:
+            raise ValueError('Truncated parse tree')
+        return self.root
+
+class ParserServer(object):
+
+    # The JVM enforces the timeout itself, this only catches it hanging
+    GRACE = 10
+
+    def __init__(self, command, binary=False, timeout=None):
+        self._command = command
+        self._binary = binary
+        self._timeout = timeout
+        self._proc = None
+        self.names = None
+
+    def _start(self):
+        self.stop()
+        with open(os.devnull, 'w') as devnull:
+            self._proc = Popen(self._command, stdin=PIPE, stdout=PIPE, stderr=devnull)
+        if self._binary:
+            (count,) = struct.unpack('>i', self._read(4))
+            names = []
+            for _ in range(count):
+                (length,) = struct.unpack('>i', self._read(4))
+                names.append(self._read(length).decode('utf-8'))
+            self.names = names
+
+    def stop(self):
+        if self._proc is None:
+            return
+        try:
+            self._proc.kill()
+        except OSError:
+            pass
+        self._proc.wait()
+        self._proc = None
+
+    def _read(self, size, deadline=None):
+        fd = self._proc.stdout.fileno()
+        chunks = []
+        while size > 0:
+            if deadline is not None and not select([fd], [], [], max(deadline - time.time(), 0))[0]:
+                # The answer stream is out of sync now
+                self.stop()
+                raise ParseTimeout('Parser server timeout')
+            chunk = os.read(fd, min(size, 1 << 20))
+            if not chunk:
+                raise IOError('Parser server died')
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def _answer(self, decoder=None):
+        # Answers come in order: each one is at most a timeout after the
+        # previous one
+        deadline = None
+        if self._timeout:
+            deadline = time.time() + self._timeout + self.GRACE
+        (length,) = struct.unpack('>i', self._read(4, deadline))
+        if length >= 0 and decoder is None:
+            return self._read(length, deadline)
+        if length >= 0:
+            # Decode while the rest is still coming
+            decoder = decoder()
+            while length > 0:
+                chunk = self._read(min(length, 1 << 16), deadline)
+                decoder.feed(chunk)
+                length -= len(chunk)
+            return decoder
+        error = ParseTimeout if length == -2 else ValueError
+        (length,) = struct.unpack('>i', self._read(4, deadline))
+        return error(self._read(length, deadline).decode('utf-8'))
+
+    def _request(self, modules, decoder=None):
+        request = [struct.pack('>i', len(modules))]
+        for data in modules:
+            request.append(struct.pack('>i', len(data)))
+            request.append(data)
+        self._proc.stdin.write(b''.join(request))
+        self._proc.stdin.flush()
+        # Read every answer before failing to keep the stream in sync
+        answers = [self._answer(decoder) for _ in modules]
+        for answer in answers:
+            if isinstance(answer, ValueError):
+                raise answer
+        return answers
+
+    def parse_all(self, modules, decoder=None):
+        # A server may have died since its last request: restart it once,
+        # but modules that kill a fresh server are simply unparsable
+        for retry in [True, False]:
+            try:
+                if self._proc is None or self._proc.poll() is not None:
+                    self._start()
+                return self._request(modules, decoder)
+            except (IOError, OSError):
+                self.stop()
+                if not retry:
+                    raise ValueError('Parser server died')
+
+class ParserPool(object):
+
+    def __init__(self, command, size, binary=False, timeout=None):
+        self._servers = [ParserServer(command, binary=binary, timeout=timeout) for _ in range(size)]
+        self._idle = Queue()
+        for server in self._servers:
+            self._idle.put(server)
+        self.binary = binary
+        self.names = None
+
+    def parse_all(self, modules, decoder=None):
+        server = self._idle.get()
+        try:
+            answers = server.parse_all(modules, decoder)
+            self.names = server.names
+            return answers
+        finally:
+            self._idle.put(server)
+
+    def close(self):
+        for server in self._servers:
+            server.stop()
 
 class Parser(object):
 
-    NEWLINE = {
-        "name": "endOfStatement",
-        "children": [
-            {
-                "name": "endOfLine",
-                "children": [
-                    {
-                        "name": "NEWLINE",
-                        "value": "\n"
-                    }
-                ]
-            }
-        ]
-    }
+    POOL_SIZE = 1
+    BINARY = True
+    # Only decode procedure blocks once used, in binary mode. Off by
+    # default: clean_arithmetic and clean_whitespaces, which come first,
+    # still look into every block
+    LAZY = False
+    CACHE = None
+    NORMALIZER = Normalizer()
+    # Per module parse timeout, in seconds
+    TIMEOUT = None
 
-    def _parse(self, data):
+    _pool = None
+    _pool_lock = Lock()
+    # Compiled xpath queries, by paths and whether only the first match
+    # is wanted
+    _queries = {}
+
+    IDENTIFIER_PATHS = (('ambiguousIdentifier', 'IDENTIFIER'), ('certainIdentifier', 'IDENTIFIER'),
+                        ('ambiguousIdentifier', 'ambiguousKeyword', '*'))
+    _jar_version = None
+    _names_cached = False
+
+    @classmethod
+    def _jars(cls):
+        path = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
         jars = ['VBA.jar', 'antlr4-4.5.3.jar', 'gson-2.7.jar']
-        jars = [os.path.join(self._path, 'parser', jar) for jar in jars]
-        proc = Popen(['java', '-cp', ':'.join(jars), 'VBA'], stdin=PIPE, stdout=PIPE, stderr=PIPE,
-                     universal_newlines=True)
-        (out, err) = proc.communicate(input=data)
+        return [os.path.join(path, 'parser', jar) for jar in jars]
+
+    @classmethod
+    def _get_pool(cls):
+        with cls._pool_lock:
+            if Parser._pool is None:
+                jars = cls._jars()
+                command = ['java', '-cp', ':'.join(jars), 'VBA', '--server']
+                if cls.BINARY:
+                    command.append('--binary')
+                if cls.TIMEOUT:
+                    command.extend(['--timeout', str(int(cls.TIMEOUT * 1000))])
+                Parser._pool = ParserPool(command, cls.POOL_SIZE, binary=cls.BINARY, timeout=cls.TIMEOUT)
+                atexit.register(Parser._pool.close)
+            return Parser._pool
+
+    @classmethod
+    def _cache_key(cls, kind, data):
+        if Parser._jar_version is None:
+            # The grammar and the serialization both live in the jar
+            with open(cls._jars()[0], 'rb') as f:
+                Parser._jar_version = hashlib.sha256(f.read()).hexdigest()
+        key = hashlib.sha256(Parser._jar_version.encode('ascii'))
+        key.update(kind)
+        key.update(data)
+        return key.hexdigest()
+
+    @classmethod
+    def _names(cls, pool):
+        # Fully cached samples should not need to start a parser server
+        key = None
+        if cls.CACHE is not None:
+            key = cls._cache_key(b'names', b'')
+        if pool.names is None and key is not None:
+            names = cls.CACHE.get(key)
+            if names is not None:
+                pool.names = json.loads(names.decode('utf-8'))
+                Parser._names_cached = True
+        if pool.names is None:
+            pool.parse_all([])
+        if key is not None and not Parser._names_cached:
+            cls.CACHE.put(key, json.dumps(pool.names).encode('utf-8'))
+            Parser._names_cached = True
+        return pool.names
+
+    def _parse_all(self, vbas):
+        if self.NORMALIZER is not None:
+            removed = self.NORMALIZER.removed
+            vbas = [self.NORMALIZER.normalize(data) for data in vbas]
+            self.normalized = self.NORMALIZER.removed - removed
+        pool = self._get_pool()
+        modules = [data if isinstance(data, bytes) else data.encode('utf-8') for data in vbas]
+        trees = [None] * len(modules)
+        if self.CACHE is not None:
+            kind = b'binary' if pool.binary else b'json'
+            keys = [self._cache_key(kind, data) for data in modules]
+            trees = [self.CACHE.get(key) for key in keys]
+        missing = [index for (index, tree) in enumerate(trees) if tree is None]
+        if pool.binary:
+            names = self._names(pool)
+            trees = [tree if tree is None else TreeDecoder.decode(names, tree, lazy=self.LAZY) for tree in trees]
+            if missing:
+                decoder = lambda: TreeDecoder(names, keep=self.CACHE is not None, lazy=self.LAZY)
+                parsed = pool.parse_all([modules[index] for index in missing], decoder)
+                for (index, tree) in zip(missing, parsed):
+                    trees[index] = tree.close()
+                    if self.CACHE is not None:
+                        self.CACHE.put(keys[index], b''.join(tree.data))
+            return trees
+        if missing:
+            parsed = pool.parse_all([modules[index] for index in missing])
+            for (index, tree) in zip(missing, parsed):
+                trees[index] = tree
+                if self.CACHE is not None:
+                    self.CACHE.put(keys[index], tree)
+        names = {}
+        def build(obj):
+            name = names.setdefault(obj['name'], obj['name'])
+            node = Node(name, obj.get('value'), obj.get('children'))
+            for child in obj.get('children', []):
+                child.parent = node
+            return node
+        return [json.loads(tree.decode('utf-8'), object_hook=build) for tree in trees]
+
+    def _parse(self, data):
+        return self._parse_all([data])[0]
+
+    @classmethod
+    def profile(cls, corpus):
+        paths = sorted(os.path.join(dirpath, filename)
+                       for (dirpath, _, filenames) in os.walk(corpus) for filename in filenames)
+        command = ['java', '-cp', ':'.join(cls._jars()), 'VBA', '--profile']
+        proc = Popen(command, stdin=PIPE, stdout=PIPE)
+        (out, _) = proc.communicate('\n'.join(paths).encode('utf-8'))
         if proc.returncode != 0:
-            return None
-        return json.loads(out)
+            raise ValueError('Unable to profile the parser')
+        return json.loads(out.decode('utf-8'))
 
     @classmethod
-    def get_node_text(cls, node):
-        ret = []
-        if node['name'] == 'EOF':
-            return ret
-        if 'value' in node:
-            ret.append(node['value'])
-        if 'children' in node:
-            for child in node['children']:
-                ret.extend(cls.get_node_text(child))
-        return ret
+    def _rule_times(cls, report):
+        times = {}
+        for decision in report['decisions']:
+            times[decision['rule']] = times.get(decision['rule'], 0) + decision['time']
+        return times
+
+    @classmethod
+    def profile_report(cls, report, previous=None, top=20):
+        modules = report['modules']
+        parsed = [module for module in modules if 'error' not in module]
+        lines = ['{0} modules in {1:.1f}s: {2} needed full LL, {3} failed, {4} unreadable'.format(
+            len(modules), sum(module['time'] for module in parsed) / 1e9,
+            len([module for module in parsed if module['ll']]),
+            len([module for module in parsed if module['failed']]),
+            len(modules) - len(parsed))]
+        lines.append('')
+        lines.append('Slowest modules:')
+        for module in sorted(parsed, key=lambda module: -module['time'])[:top]:
+            lines.append('{0:10.1f}ms {1:2} {2}'.format(module['time'] / 1e6, 'LL' if module['ll'] else '',
+                                                        module['path']))
+        lines.append('')
+        lines.append('Slowest decisions:')
+        lines.append('{0:>12} {1:>10} {2:>13} {3:>8} {4:>13} {5:>6}  {6}'.format(
+            'time', 'calls', 'SLL look/max', 'LL', 'LL look/max', 'ambig', 'rule (decision)'))
+        for decision in sorted(report['decisions'], key=lambda decision: -decision['time'])[:top]:
+            lines.append('{0:10.1f}ms {1:10} {2:8.1f}/{3:<4} {4:8} {5:8.1f}/{6:<4} {7:6}  {8} ({9})'.format(
+                decision['time'] / 1e6, decision['invocations'],
+                float(decision['sll_lookahead']) / decision['invocations'], decision['sll_max_lookahead'],
+                decision['ll_fallback'],
+                float(decision['ll_lookahead']) / decision['ll_fallback'] if decision['ll_fallback'] else 0,
+                decision['ll_max_lookahead'], decision['ambiguities'], decision['rule'], decision['decision']))
+        if previous is not None:
+            # Decision numbers change with the grammar, rule names do not
+            before = cls._rule_times(previous)
+            after = cls._rule_times(report)
+            lines.append('')
+            lines.append('Prediction time per rule, against the previous report:')
+            for rule in sorted(set(before) | set(after), key=lambda rule: before.get(rule, 0) - after.get(rule, 0))[:top]:
+                lines.append('{0:10.1f}ms -> {1:10.1f}ms  {2}'.format(before.get(rule, 0) / 1e6, after.get(rule, 0) / 1e6,
+                                                                      rule))
+        return '\n'.join(lines)
+
+    @classmethod
+    def compare(cls, corpus):
+        # Two-stage (SLL first) against full LL parsing of every module
+        paths = sorted(os.path.join(dirpath, filename)
+                       for (dirpath, _, filenames) in os.walk(corpus) for filename in filenames)
+        command = ['java', '-cp', ':'.join(cls._jars()), 'VBA', '--compare']
+        proc = Popen(command, stdin=PIPE, stdout=PIPE)
+        (out, _) = proc.communicate('\n'.join(paths).encode('utf-8'))
+        if proc.returncode != 0:
+            raise ValueError('Unable to compare the parsers')
+        return json.loads(out.decode('utf-8'))
+
+    @classmethod
+    def compare_report(cls, report):
+        parsed = [module for module in report if 'error' not in module]
+        lines = ['{0} modules: {1} parsed with SLL only, {2} with different trees, {3} unreadable'.format(
+            len(report), len([module for module in parsed if module['sll']]),
+            len([module for module in parsed if not module['same']]), len(report) - len(parsed))]
+        lines.append('Two-stage parsing: {0:.1f}s, full LL: {1:.1f}s'.format(
+            sum(module['two_stage_time'] for module in parsed) / 1e9,
+            sum(module['ll_time'] for module in parsed) / 1e9))
+        for module in parsed:
+            if not module['same']:
+                lines.append('Different trees: {0}'.format(module['path']))
+        return '\n'.join(lines)
+
+    @classmethod
+    def dispatch_table(cls, visitor, prefix='_handle_'):
+        # Node name -> handler function of a visitor class, collected once
+        # instead of formatting and looking up the name on every node
+        table = {}
+        for klass in reversed(visitor.__mro__):
+            for (attr, value) in vars(klass).items():
+                if attr.startswith(prefix):
+                    table[attr[len(prefix):]] = value
+        return table
+
+    @classmethod
+    def walk(cls, node):
+        # Pre-order, with an explicit stack: long concatenations make for
+        # trees deeper than the recursion limit
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            yield node
+            children = node.get('children')
+            if children:
+                stack.extend(reversed(children))
+
+    @classmethod
+    def get_node_text(cls, node, acc=None):
+        if acc is None:
+            acc = []
+        for child in cls.walk(node):
+            if 'value' in child and child['name'] != 'EOF':
+                acc.append(child['value'])
+        return acc
+
+    @classmethod
+    def _query(cls, paths, first):
+        try:
+            return cls._queries[(paths, first)]
+        except KeyError:
+            pass
+        # One nested loop per step, the paths one after the other: a first
+        # match query returns as soon as it finds something
+        lines = ['def query(node):', '    found = []']
+        for path in paths:
+            parent = 'node'
+            indent = '    '
+            for (depth, name) in enumerate(path):
+                child = 'child{0}'.format(depth)
+                lines.append('{0}for {1} in getattr({2}, "children", ()):'.format(indent, child, parent))
+                indent += '    '
+                if name != '*':
+                    lines.append('{0}if {1}.name == {2!r}:'.format(indent, child, name))
+                    indent += '    '
+                parent = child
+            if first:
+                lines.append('{0}return {1}'.format(indent, parent))
+            else:
+                lines.append('{0}found.append({1})'.format(indent, parent))
+        lines.append('    return None' if first else '    return found')
+        namespace = {}
+        exec('\n'.join(lines), namespace)
+        query = cls._queries[(paths, first)] = namespace['query']
+        return query
 
     @classmethod
     def xpath(cls, node, path):
-        if not path:
-            return [node]
-        if 'children' not in node:
-            return []
-        name, path = path[0], path[1:]
-        if name == '*':
-            return [elt for child in node['children'] for elt in cls.xpath(child, path)]
-        ret = []
-        for child in node['children']:
-            if child['name'] == name:
-                ret.extend(cls.xpath(child, path))
-        return ret
+        return cls._query((tuple(path),), False)(node)
+
+    @classmethod
+    def xpath_first(cls, node, *paths):
+        # First match of the first path having one, or None
+        return cls._query(tuple(map(tuple, paths)), True)(node)
 
     @classmethod
     def findall(cls, node, node_name):
-        ret = []
-        if node['name'] == node_name:
-            ret.append(node)
-        if 'children' not in node:
-            return ret
-        for child in node['children']:
-            ret.extend(cls.findall(child, node_name))
-        return ret
+        index = getattr(node, 'index', None)
+        if index is not None:
+            return index.findall(node, node_name)
+        return [child for child in cls.walk(node) if child['name'] == node_name]
 
     @classmethod
     def getallidentifiers(cls, node, acc=None):
         if acc is None:
             acc = set()
-        for identifier in cls.findall(node, 'IDENTIFIER'):
+        index = getattr(node, 'index', None)
+        if index is None:
+            identifiers = cls.findall(node, 'IDENTIFIER')
+        else:
+            # No need to load the pending blocks for that
+            for lazy in index.pending(node):
+                acc.update(lazy.identifiers)
+            identifiers = index.findall(node, 'IDENTIFIER', load=False)
+        for identifier in identifiers:
             acc.add(identifier['value'])
         return acc
 
@@ -91,26 +610,14 @@ class Parser(object):
     def getallclasses(cls, node, acc=None):
         if acc is None:
             acc = set()
-        acc.add(node['name'])
-        if 'children' in node:
-            for child in node['children']:
-                cls.getallclasses(child, acc=acc)
+        acc.update(child['name'] for child in cls.walk(node))
         return acc
 
     @classmethod
     def identifier_name(cls, node):
-        try:
-            return cls.xpath(node, ['ambiguousIdentifier', 'IDENTIFIER'])[0]['value']
-        except IndexError:
-            pass
-        try:
-            return cls.xpath(node, ['certainIdentifier', 'IDENTIFIER'])[0]['value']
-        except IndexError:
-            pass
-        try:
-            return cls.xpath(node, ['ambiguousIdentifier', 'ambiguousKeyword', '*'])[0]['value']
-        except IndexError:
-            pass
+        identifier = cls._query(cls.IDENTIFIER_PATHS, True)(node)
+        if identifier is not None:
+            return identifier['value']
         # Might be a "iCS_S_MembersCall", but we don't want those
         return None
 
@@ -143,31 +650,27 @@ class Parser(object):
                     ret.append(name)
         for node_type in ['setStmt', 'letStmt']:
             for setstmt in cls.findall(node, node_type):
-                var = cls.xpath(setstmt, ['implicitCallStmt_InStmt', '*'])[0]
+                var = cls.xpath_first(setstmt, ['implicitCallStmt_InStmt', '*'])
                 name = cls.identifier_name(var)
                 if name and name not in ret:
                     ret.append(name)
         return ret
 
-    def _double_link(self, node, parent=None):
-        if parent is not None:
-            node['parent'] = parent
-        if 'children' in node:
-            for child in node['children']:
-                self._double_link(child, node)
-
     def __init__(self, vbas):
-        self._path = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+        self.normalized = 0
         try:
-            contents = [self._parse(data) for data in vbas]
+            contents = self._parse_all(vbas)
+        except ParseTimeout:
+            print('Timeout while parsing the VBA')
+            raise RuntimeError('Timeout while parsing the VBA')
         except ValueError as e:
             print('Unable to parse the VBA')
             print("The VBA doesn't match our grammar or your forgot to compile it (cd parser && make)")
             raise RuntimeError('Unable to parse the VBA')
         self._content = contents
-        self.attr = {'name': 'moduleAttributes', 'children': []}
-        self.decl = {'name': 'moduleDeclarations', 'children': []}
-        self.body = {'name': 'moduleBody', 'children': []}
+        self.attr = Node('moduleAttributes', children=[])
+        self.decl = Node('moduleDeclarations', children=[])
+        self.body = Node('moduleBody', children=[])
         for content in contents:
             attrs = self.xpath(content, ['module', 'moduleAttributes', '*'])
             self.attr['children'].extend(attrs)
@@ -175,32 +678,87 @@ class Parser(object):
             self.decl['children'].extend(decls)
             bodys = self.xpath(content, ['module', 'moduleBody', '*'])
             self.body['children'].extend(bodys)
-        self._double_link(self.attr, None)
-        self._double_link(self.decl, None)
-        self._double_link(self.body, None)
+        # The decoders already link the parents, only the new roots remain
+        for root in [self.attr, self.decl, self.body]:
+            for child in root.children:
+                child.parent = root
+        self._index = NodeIndex([self.attr, self.decl, self.body])
 
     def get_text(self, node=None):
         if node is None:
-            attrs = self.get_node_text(self.attr)
-            decls = self.get_node_text(self.decl)
-            body = self.get_node_text(self.body)
-            return ''.join([''.join(attrs), ''.join(decls), ''.join(body)])
+            text = []
+            for root in [self.attr, self.decl, self.body]:
+                self.get_node_text(root, acc=text)
+            return ''.join(text)
         else:
             return ''.join(self.get_node_text(node))
 
     def print_node(self, node, indent=0):
-        print('{0}{1}:{2}'.format(' '*indent, node['name'], node['value'] if 'value' in node else ""))
-        if 'children' in node:
-            for child in node['children']:
-                self.print_node(child, indent=(indent+2))
+        stack = [(node, indent)]
+        while stack:
+            (node, indent) = stack.pop()
+            print('{0}{1}:{2}'.format(' '*indent, node['name'], node['value'] if 'value' in node else ""))
+            stack.extend((child, indent + 2) for child in reversed(node.get('children', [])))
 
     @classmethod
     def newline(cls):
-        return deepcopy(cls.NEWLINE)
+        # A canonical newline: endOfStatement > endOfLine > NEWLINE '\n'.
+        # Built directly, this is called for every statement the passes keep
+        token = Node('NEWLINE', '\n')
+        end_of_line = Node('endOfLine', children=[token])
+        token.parent = end_of_line
+        newline = Node('endOfStatement', children=[end_of_line])
+        end_of_line.parent = newline
+        return newline
+
+    @classmethod
+    def is_newline(cls, node):
+        # Whether node is already a canonical newline, and can be kept
+        children = node.get('children')
+        if node['name'] != 'endOfStatement' or not children or len(children) != 1:
+            return False
+        children = children[0].get('children')
+        if not children or len(children) != 1 or 'children' in children[0]:
+            return False
+        return children[0]['name'] == 'NEWLINE' and children[0].get('value') == '\n'
+
+    @classmethod
+    def separate(cls, node, statements):
+        # Sets the children of node to statements, each followed by a
+        # newline. The newlines already there are kept: nothing is changed
+        # for a block that already is in that form.
+        children = node.get('children', [])
+        following = dict((id(child), children[position + 1]) for (position, child) in enumerate(children[:-1]))
+        res = []
+        for statement in statements:
+            newline = following.get(id(statement))
+            if newline is None or not cls.is_newline(newline):
+                newline = cls.newline()
+            res.extend((statement, newline))
+        if len(res) != len(children) or any(new is not old for (new, old) in zip(res, children)):
+            node['children'] = res
 
 if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == '-p':
+        # -p corpus_dir [-o report.json] [-c previous_report.json]
+        options = dict(zip(sys.argv[3::2], sys.argv[4::2]))
+        REPORT = Parser.profile(sys.argv[2])
+        PREVIOUS = None
+        if '-c' in options:
+            with open(options['-c']) as f:
+                PREVIOUS = json.load(f)
+        if '-o' in options:
+            with open(options['-o'], 'w') as f:
+                json.dump(REPORT, f)
+        print(Parser.profile_report(REPORT, previous=PREVIOUS))
+        sys.exit(0)
+    if len(sys.argv) == 3 and sys.argv[1] == '-s':
+        # -s corpus_dir: two-stage against full LL parsing
+        print(Parser.compare_report(Parser.compare(sys.argv[2])))
+        sys.exit(0)
     if len(sys.argv) != 2:
-        print('Expected 1 argument: file to analyse')
+        print('Expected 1 argument: file to analyse, -p corpus_dir to profile the parser, '
+              'or -s corpus_dir to check SLL parsing')
         sys.exit(-1)
     from extractor import Extractor
     VBAS = Extractor(sys.argv[1])
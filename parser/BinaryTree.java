@@ -0,0 +1,167 @@
+import java.io.ByteArrayOutputStream;
+import java.io.DataOutputStream;
+import java.io.IOException;
+import java.io.UncheckedIOException;
+import java.nio.charset.StandardCharsets;
+import java.util.ArrayList;
+import java.util.HashMap;
+import java.util.HashSet;
+import java.util.List;
+import java.util.Map;
+import java.util.Set;
+
+import org.antlr.v4.runtime.*;
+import org.antlr.v4.runtime.tree.*;
+
+/*
+ * Compact tree format: a pool holding every token text (count, end
+ * offsets, then the UTF-8 bytes), the procedure chunks (count, then for
+ * each procedure block its first and past the last node, the name ids and
+ * the IDENTIFIER value indices found below it, each list prefixed by its
+ * length), followed by the nodes in pre-order as (name id, child count,
+ * value index) int triples, value index being -1 for rules. Name ids
+ * refer to names(): rule names, then token names starting with EOF.
+ */
+public class BinaryTree implements ParseTreeVisitor<Void> {
+
+	private static class Chunk {
+		final int start;
+		int end;
+		final Set<Integer> names = new HashSet<Integer>();
+		final Map<String, Integer> identifiers = new HashMap<String, Integer>();
+
+		Chunk(int start) {
+			this.start = start;
+		}
+	}
+
+	private int rules;
+	private int values;
+	private int nodes;
+	private ByteArrayOutputStream pool;
+	private ByteArrayOutputStream ends;
+	private ByteArrayOutputStream records;
+	private DataOutputStream endsOut;
+	private DataOutputStream recordsOut;
+	private boolean error;
+	private List<Chunk> chunks;
+	private Chunk chunk;
+
+	public BinaryTree() {
+		this.rules = vbaParser.ruleNames.length;
+		this.values = 0;
+		this.nodes = 0;
+		this.pool = new ByteArrayOutputStream();
+		this.ends = new ByteArrayOutputStream();
+		this.records = new ByteArrayOutputStream();
+		this.endsOut = new DataOutputStream(this.ends);
+		this.recordsOut = new DataOutputStream(this.records);
+		this.error = false;
+		this.chunks = new ArrayList<Chunk>();
+		this.chunk = null;
+	}
+
+	public static List<String> names() {
+		List<String> names = new ArrayList<String>();
+		for (String rule : vbaParser.ruleNames) {
+			names.add(rule);
+		}
+		for (int type = Token.EOF; type <= vbaParser.VOCABULARY.getMaxTokenType(); type++) {
+			names.add(vbaParser.VOCABULARY.getDisplayName(type));
+		}
+		return names;
+	}
+
+	private void record(int name, int children, int value) {
+		if (this.chunk != null && this.nodes > this.chunk.start) {
+			this.chunk.names.add(name);
+		}
+		try {
+			this.recordsOut.writeInt(name);
+			this.recordsOut.writeInt(children);
+			this.recordsOut.writeInt(value);
+		} catch (IOException e) {
+			throw new UncheckedIOException(e);
+		}
+		this.nodes++;
+	}
+
+	@Override
+	public Void visit(ParseTree tree) {
+		return tree.accept(this);
+	}
+
+	@Override
+	public Void visitChildren(RuleNode node) {
+		int n = node.getChildCount();
+		boolean chunk = (this.chunk == null && node instanceof vbaParser.BlockContext
+				&& node.getParent() != null
+				&& node.getParent().getParent() instanceof vbaParser.ModuleBodyElementContext);
+		if (chunk) {
+			this.chunk = new Chunk(this.nodes);
+		}
+		record(node.getRuleContext().getRuleIndex(), n, -1);
+		for (int i=0; i<n; i++) {
+			node.getChild(i).accept(this);
+		}
+		if (chunk) {
+			this.chunk.end = this.nodes;
+			this.chunks.add(this.chunk);
+			this.chunk = null;
+		}
+		return null;
+	}
+
+	@Override
+	public Void visitTerminal(TerminalNode node) {
+		byte[] raw = node.getSymbol().getText().getBytes(StandardCharsets.UTF_8);
+		this.pool.write(raw, 0, raw.length);
+		try {
+			this.endsOut.writeInt(this.pool.size());
+		} catch (IOException e) {
+			throw new UncheckedIOException(e);
+		}
+		if (this.chunk != null && node.getSymbol().getType() == vbaParser.IDENTIFIER
+				&& !this.chunk.identifiers.containsKey(node.getSymbol().getText())) {
+			this.chunk.identifiers.put(node.getSymbol().getText(), this.values);
+		}
+		record(this.rules + 1 + node.getSymbol().getType(), 0, this.values++);
+		return null;
+	}
+
+	@Override
+	public Void visitErrorNode(ErrorNode node) {
+		this.error = true;
+		return null;
+	}
+
+	public boolean failed() {
+		return this.error;
+	}
+
+	public byte[] toByteArray() throws IOException {
+		ByteArrayOutputStream raw = new ByteArrayOutputStream();
+		DataOutputStream out = new DataOutputStream(raw);
+		out.writeInt(this.values);
+		this.ends.writeTo(out);
+		out.writeInt(this.pool.size());
+		this.pool.writeTo(out);
+		out.writeInt(this.chunks.size());
+		for (Chunk chunk : this.chunks) {
+			out.writeInt(chunk.start);
+			out.writeInt(chunk.end);
+			out.writeInt(chunk.names.size());
+			for (int name : chunk.names) {
+				out.writeInt(name);
+			}
+			out.writeInt(chunk.identifiers.size());
+			for (int value : chunk.identifiers.values()) {
+				out.writeInt(value);
+			}
+		}
+		out.writeInt(this.nodes);
+		this.records.writeTo(out);
+		out.flush();
+		return raw.toByteArray();
+	}
+}
@@ -1,79 +1,500 @@
-import java.util.HashMap;
+import java.util.ArrayList;
+import java.util.List;
+import java.util.concurrent.Callable;
+import java.util.concurrent.ExecutionException;
+import java.util.concurrent.ExecutorService;
+import java.util.concurrent.Executors;
+import java.util.concurrent.Future;
+import java.util.concurrent.ThreadFactory;
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.BufferedReader;
+import java.io.BufferedWriter;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.io.IOException;
 import java.io.InputStreamReader;
+import java.io.OutputStreamWriter;
+import java.io.UncheckedIOException;
+import java.io.Writer;
+import java.nio.charset.StandardCharsets;
 
 import org.antlr.v4.runtime.*;
+import org.antlr.v4.runtime.atn.DecisionInfo;
+import org.antlr.v4.runtime.atn.PredictionMode;
+import org.antlr.v4.runtime.misc.ParseCancellationException;
 import org.antlr.v4.runtime.tree.*;
-import com.google.gson.Gson;
+import com.google.gson.stream.JsonWriter;
 
-public class VBA implements ParseTreeVisitor<String> {
+public class VBA implements ParseTreeVisitor<Void> {
 
 	private Vocabulary voc;
 	private String[] rules;
-	private Gson gson;
+	private JsonWriter out;
+	private boolean error;
 
-	public VBA(vbaParser parser) {
-		this.voc = parser.getVocabulary();
-		this.rules = parser.getRuleNames();
-		this.gson = new Gson();
+	public VBA(Writer out) {
+		this.voc = vbaParser.VOCABULARY;
+		this.rules = vbaParser.ruleNames;
+		this.out = new JsonWriter(out);
+		this.error = false;
 	}
 
 	@Override
-	public String visit(ParseTree tree) {
+	public Void visit(ParseTree tree) {
 		return tree.accept(this);
 	}
 
 	@Override
-	public String visitChildren(RuleNode node) {
-		String name = this.rules[node.getRuleContext().getRuleIndex()];
-		String content = "{ \"name\": " + gson.toJson(name);
-		int n = node.getChildCount();
-		if (n == 0) {
-			return content + "}";
-		}
-		String children = "";
-		for (int i=0; i<n; i++) {
-			ParseTree child = node.getChild(i);
-                        if (children != "") {
-				children = children + "," + child.accept(this);
-			} else {
-				children = child.accept(this);
+	public Void visitChildren(RuleNode node) {
+		try {
+			this.out.beginObject();
+			this.out.name("name").value(this.rules[node.getRuleContext().getRuleIndex()]);
+			int n = node.getChildCount();
+			if (n > 0) {
+				this.out.name("children").beginArray();
+				for (int i=0; i<n; i++) {
+					node.getChild(i).accept(this);
+				}
+				this.out.endArray();
 			}
+			this.out.endObject();
+		} catch (IOException e) {
+			throw new UncheckedIOException(e);
 		}
-		return content + ", \"children\": [" + children + "]}";
+		return null;
 	}
 
-	@Override
-	public String visitTerminal(TerminalNode node) {
-		HashMap<String, String> content = new HashMap<String, String>();
+	public static String terminalName(Vocabulary voc, int type) {
 		try {
-			content.put("name", this.voc.getDisplayName(node.getSymbol().getType()));
+			return voc.getDisplayName(type);
 		} catch (IndexOutOfBoundsException e) {
-			if (node.getSymbol().getType() == 1) {
-				content.put("name", "EOF");
+			if (type == 1) {
+				return "EOF";
 			} else {
-				content.put("name", "Unknown (" + node.getSymbol().getType() + ")");
+				return "Unknown (" + type + ")";
 			}
 		}
-		content.put("value", node.getSymbol().getText());
-		return gson.toJson(content);
 	}
 
 	@Override
-	public String visitErrorNode(ErrorNode node) {
-		System.out.println("ERROR");
-		return "";
+	public Void visitTerminal(TerminalNode node) {
+		try {
+			this.out.beginObject();
+			this.out.name("name").value(terminalName(this.voc, node.getSymbol().getType()));
+			this.out.name("value").value(node.getSymbol().getText());
+			this.out.endObject();
+		} catch (IOException e) {
+			throw new UncheckedIOException(e);
+		}
+		return null;
+	}
+
+	@Override
+	public Void visitErrorNode(ErrorNode node) {
+		this.error = true;
+		return null;
+	}
+
+	public boolean failed() {
+		return this.error;
+	}
+
+	public void flush() throws IOException {
+		this.out.flush();
+	}
+
+	public static class ParseTimeoutException extends RuntimeException {
+		public ParseTimeoutException() {
+			super("Parse timeout");
+		}
+	}
+
+	/*
+	 * Both the parser and its adaptive prediction read their input
+	 * through LA/LT: check the deadline there, every few thousand calls.
+	 */
+	private static class DeadlineTokenStream extends CommonTokenStream {
+
+		private long deadline;
+		private int calls;
+
+		public DeadlineTokenStream(TokenSource source, long timeout) {
+			super(source);
+			this.deadline = timeout > 0 ? System.nanoTime() + timeout * 1000000 : 0;
+			this.calls = 0;
+		}
+
+		private void check() {
+			if (this.deadline != 0 && (++this.calls & 0xfff) == 0 && System.nanoTime() - this.deadline > 0) {
+				throw new ParseTimeoutException();
+			}
+		}
+
+		@Override
+		public int LA(int i) {
+			check();
+			return super.LA(i);
+		}
+
+		@Override
+		public Token LT(int k) {
+			check();
+			return super.LT(k);
+		}
+	}
+
+	/*
+	 * Two-stage parsing: SLL prediction is much faster and enough for
+	 * almost every module, full LL is only needed when SLL fails. Syntax
+	 * errors are only reported (as error nodes) by the LL stage.
+	 */
+	private static vbaParser parser(CharStream input, long timeout, boolean quiet) {
+		vbaLexer lexer = new vbaLexer(input);
+		if (quiet) {
+			lexer.removeErrorListeners();
+		}
+		vbaParser parser = new vbaParser(new DeadlineTokenStream(lexer, timeout));
+		parser.removeErrorListeners();
+		return parser;
+	}
+
+	private static ParseTree parseTree(vbaParser parser, boolean quiet) {
+		parser.getInterpreter().setPredictionMode(PredictionMode.SLL);
+		parser.setErrorHandler(new BailErrorStrategy());
+		try {
+			return parser.startRule();
+		} catch (ParseCancellationException e) {
+			parser.getTokenStream().seek(0);
+			parser.reset();
+			if (!quiet) {
+				parser.addErrorListener(ConsoleErrorListener.INSTANCE);
+			}
+			parser.getInterpreter().setPredictionMode(PredictionMode.LL);
+			parser.setErrorHandler(new DefaultErrorStrategy());
+			return parser.startRule();
+		}
+	}
+
+	/*
+	 * Server mode: every request is a big-endian int count followed by
+	 * that many modules, each one an int length and the UTF-8 encoded
+	 * module. The modules are parsed concurrently and answered in order,
+	 * each answer being either a length followed by the tree (UTF-8
+	 * encoded JSON, or BinaryTree if --binary was given), or -1 (error)
+	 * or -2 (timeout, with --timeout milliseconds) followed by a length
+	 * and an UTF-8 encoded message. In binary mode the name table (a
+	 * count, then length-prefixed names) is sent once at startup.
+	 * The lexer and parser are recreated for each module but the ATN/DFA
+	 * caches are static, so they stay warm.
+	 */
+	private static byte[] parse(String data, boolean binary, long timeout) throws IOException {
+		ParseTree tree = parseTree(parser(new ANTLRInputStream(data), timeout, true), true);
+		if (binary) {
+			BinaryTree visitor = new BinaryTree();
+			visitor.visit(tree);
+			if (visitor.failed()) {
+				throw new RuntimeException("Unable to parse the VBA");
+			}
+			return visitor.toByteArray();
+		}
+		ByteArrayOutputStream out = new ByteArrayOutputStream();
+		VBA visitor = new VBA(new BufferedWriter(new OutputStreamWriter(out, StandardCharsets.UTF_8)));
+		visitor.visit(tree);
+		if (visitor.failed()) {
+			throw new RuntimeException("Unable to parse the VBA");
+		}
+		visitor.flush();
+		return out.toByteArray();
+	}
+
+	private static ExecutorService executor(int threads) {
+		return Executors.newFixedThreadPool(threads, new ThreadFactory() {
+			@Override
+			public Thread newThread(Runnable r) {
+				// Long concatenation chains make for very deep trees
+				Thread thread = new Thread(null, r, "parser", 1 << 26);
+				thread.setDaemon(true);
+				return thread;
+			}
+		});
+	}
+
+	private static List<Future<byte[]>> parseAll(ExecutorService pool, List<String> modules, final boolean binary, final long timeout) {
+		List<Future<byte[]>> trees = new ArrayList<Future<byte[]>>();
+		for (final String module : modules) {
+			trees.add(pool.submit(new Callable<byte[]>() {
+				@Override
+				public byte[] call() throws IOException {
+					return parse(module, binary, timeout);
+				}
+			}));
+		}
+		return trees;
+	}
+
+	private static void write(DataOutputStream out, byte[] data) throws IOException {
+		out.writeInt(data.length);
+		out.write(data);
+	}
+
+	private static void serve(int threads, boolean binary, long timeout) throws Exception {
+		DataInputStream in = new DataInputStream(new BufferedInputStream(System.in));
+		DataOutputStream out = new DataOutputStream(new BufferedOutputStream(System.out));
+		ExecutorService pool = executor(threads);
+		if (binary) {
+			List<String> names = BinaryTree.names();
+			out.writeInt(names.size());
+			for (String name : names) {
+				write(out, name.getBytes(StandardCharsets.UTF_8));
+			}
+			out.flush();
+		}
+		while (true) {
+			int count;
+			try {
+				count = in.readInt();
+			} catch (EOFException e) {
+				return;
+			}
+			List<String> modules = new ArrayList<String>();
+			for (int i = 0; i < count; i++) {
+				byte[] raw = new byte[in.readInt()];
+				in.readFully(raw);
+				modules.add(new String(raw, StandardCharsets.UTF_8));
+			}
+			for (Future<byte[]> future : parseAll(pool, modules, binary, timeout)) {
+				byte[] tree = null;
+				Throwable error = null;
+				try {
+					tree = future.get();
+				} catch (ExecutionException e) {
+					error = e.getCause();
+				}
+				if (error == null) {
+					write(out, tree);
+				} else {
+					out.writeInt(error instanceof ParseTimeoutException ? -2 : -1);
+					write(out, String.valueOf(error.getMessage()).getBytes(StandardCharsets.UTF_8));
+				}
+			}
+			out.flush();
+		}
+	}
+
+	private static class DecisionStats {
+
+		private long invocations;
+		private long time;
+		private long sllLook;
+		private long sllMaxLook;
+		private long llFallback;
+		private long llLook;
+		private long llMaxLook;
+		private long ambiguities;
+		private long contextSensitivities;
+		private long errors;
+
+		public void add(DecisionInfo info) {
+			this.invocations += info.invocations;
+			this.time += info.timeInPrediction;
+			this.sllLook += info.SLL_TotalLook;
+			this.sllMaxLook = Math.max(this.sllMaxLook, info.SLL_MaxLook);
+			this.llFallback += info.LL_Fallback;
+			this.llLook += info.LL_TotalLook;
+			this.llMaxLook = Math.max(this.llMaxLook, info.LL_MaxLook);
+			this.ambiguities += info.ambiguities.size();
+			this.contextSensitivities += info.contextSensitivities.size();
+			this.errors += info.errors.size();
+		}
+
+		public void write(JsonWriter out, int decision) throws IOException {
+			int rule = vbaParser._ATN.getDecisionState(decision).ruleIndex;
+			out.beginObject();
+			out.name("decision").value(decision);
+			out.name("rule").value(vbaParser.ruleNames[rule]);
+			out.name("invocations").value(this.invocations);
+			out.name("time").value(this.time);
+			out.name("sll_lookahead").value(this.sllLook);
+			out.name("sll_max_lookahead").value(this.sllMaxLook);
+			out.name("ll_fallback").value(this.llFallback);
+			out.name("ll_lookahead").value(this.llLook);
+			out.name("ll_max_lookahead").value(this.llMaxLook);
+			out.name("ambiguities").value(this.ambiguities);
+			out.name("context_sensitivities").value(this.contextSensitivities);
+			out.name("errors").value(this.errors);
+			out.endObject();
+		}
+	}
+
+	/*
+	 * Profile mode: parse the files listed on stdin (one path per line)
+	 * one at a time with ANTLR profiling on, then output as JSON the parse
+	 * time of each module and the prediction stats of each grammar
+	 * decision, summed over all the modules. Times are in nanoseconds.
+	 */
+	private static void profile() throws IOException {
+		BufferedReader in = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+		JsonWriter out = new JsonWriter(new BufferedWriter(new OutputStreamWriter(System.out, StandardCharsets.UTF_8)));
+		DecisionStats[] decisions = new DecisionStats[vbaParser._ATN.getNumberOfDecisions()];
+		for (int i = 0; i < decisions.length; i++) {
+			decisions[i] = new DecisionStats();
+		}
+		out.beginObject();
+		out.name("modules").beginArray();
+		String path;
+		while ((path = in.readLine()) != null) {
+			if (path.isEmpty()) {
+				continue;
+			}
+			out.beginObject();
+			out.name("path").value(path);
+			long start = System.nanoTime();
+			try {
+				vbaParser parser = parser(new ANTLRFileStream(path, "UTF-8"), 0, true);
+				parser.setProfile(true);
+				parseTree(parser, true);
+				out.name("time").value(System.nanoTime() - start);
+				out.name("ll").value(parser.getInterpreter().getPredictionMode() == PredictionMode.LL);
+				out.name("failed").value(parser.getNumberOfSyntaxErrors() > 0);
+				for (DecisionInfo info : parser.getParseInfo().getDecisionInfo()) {
+					decisions[info.decision].add(info);
+				}
+			} catch (IOException | RuntimeException e) {
+				out.name("error").value(String.valueOf(e.getMessage()));
+			}
+			out.endObject();
+		}
+		out.endArray();
+		out.name("decisions").beginArray();
+		for (int i = 0; i < decisions.length; i++) {
+			if (decisions[i].invocations > 0) {
+				decisions[i].write(out, i);
+			}
+		}
+		out.endArray();
+		out.endObject();
+		out.flush();
+		System.out.println();
+	}
+
+	/*
+	 * Compare mode: parse the files listed on stdin (one path per line)
+	 * with the two-stage parsing, then with full LL prediction only, and
+	 * output as JSON, for each module, whether SLL was enough, both parse
+	 * times (in nanoseconds) and whether both trees are the same.
+	 */
+	private static void compare() throws Exception {
+		BufferedReader in = new BufferedReader(new InputStreamReader(System.in, StandardCharsets.UTF_8));
+		JsonWriter out = new JsonWriter(new BufferedWriter(new OutputStreamWriter(System.out, StandardCharsets.UTF_8)));
+		// Deep trees: parse and print them on a thread with a large stack
+		ExecutorService pool = executor(1);
+		out.beginArray();
+		String path;
+		while ((path = in.readLine()) != null) {
+			if (path.isEmpty()) {
+				continue;
+			}
+			out.beginObject();
+			out.name("path").value(path);
+			try {
+				final String data = new ANTLRFileStream(path, "UTF-8").toString();
+				long[] result = pool.submit(new Callable<long[]>() {
+					@Override
+					public long[] call() {
+						long start = System.nanoTime();
+						vbaParser twoStage = parser(new ANTLRInputStream(data), 0, true);
+						ParseTree first = parseTree(twoStage, true);
+						long middle = System.nanoTime();
+						vbaParser ll = parser(new ANTLRInputStream(data), 0, true);
+						ll.getInterpreter().setPredictionMode(PredictionMode.LL);
+						ParseTree second = ll.startRule();
+						long end = System.nanoTime();
+						boolean sll = twoStage.getInterpreter().getPredictionMode() == PredictionMode.SLL;
+						boolean same = Trees.toStringTree(first, twoStage).equals(Trees.toStringTree(second, ll));
+						return new long[] {sll ? 1 : 0, middle - start, end - middle, same ? 1 : 0};
+					}
+				}).get();
+				out.name("sll").value(result[0] == 1);
+				out.name("two_stage_time").value(result[1]);
+				out.name("ll_time").value(result[2]);
+				out.name("same").value(result[3] == 1);
+			} catch (ExecutionException e) {
+				out.name("error").value(String.valueOf(e.getCause().getMessage()));
+			} catch (IOException e) {
+				out.name("error").value(String.valueOf(e.getMessage()));
+			}
+			out.endObject();
+		}
+		out.endArray();
+		out.flush();
+		System.out.println();
+		pool.shutdown();
 	}
 
 	public static void main( String[] args) throws Exception {
-		vbaLexer lexer;
+		if (args.length > 0 && args[0].equals("--profile")) {
+			profile();
+			return;
+		}
+		if (args.length > 0 && args[0].equals("--compare")) {
+			compare();
+			return;
+		}
+		if (args.length > 0 && args[0].equals("--server")) {
+			int threads = Runtime.getRuntime().availableProcessors();
+			boolean binary = false;
+			long timeout = 0;
+			for (int i = 1; i < args.length; i++) {
+				if (args[i].equals("--binary")) {
+					binary = true;
+				} else if (args[i].equals("--timeout")) {
+					timeout = Long.parseLong(args[++i]);
+				} else {
+					threads = Integer.parseInt(args[i]);
+				}
+			}
+			serve(threads, binary, timeout);
+			return;
+		}
+		if (args.length > 1) {
+			List<String> modules = new ArrayList<String>();
+			for (String arg : args) {
+				modules.add(new ANTLRFileStream(arg).toString());
+			}
+			ExecutorService pool = executor(Runtime.getRuntime().availableProcessors());
+			BufferedOutputStream out = new BufferedOutputStream(System.out);
+			out.write('[');
+			boolean first = true;
+			for (Future<byte[]> future : parseAll(pool, modules, false, 0)) {
+				if (!first) {
+					out.write(',');
+				}
+				out.write(future.get());
+				first = false;
+			}
+			out.write(']');
+			out.write('\n');
+			out.flush();
+			return;
+		}
+		CharStream input;
 		if (args.length > 0) {
-			lexer = new vbaLexer(new ANTLRFileStream(args[0]));
+			input = new ANTLRFileStream(args[0]);
 		} else {
-			lexer = new vbaLexer(new ANTLRInputStream(new InputStreamReader(System.in)));
+			input = new ANTLRInputStream(new InputStreamReader(System.in));
+		}
+		ParseTree tree = parseTree(parser(input, 0, false), false);
+		Writer out = new BufferedWriter(new OutputStreamWriter(System.out));
+		VBA visitor = new VBA(out);
+		visitor.visit(tree);
+		visitor.flush();
+		out.write('\n');
+		if (visitor.failed()) {
+			out.write("ERROR\n");
 		}
-		CommonTokenStream tokens = new CommonTokenStream( lexer );
-		vbaParser parser = new vbaParser( tokens );
-		ParseTree tree = parser.startRule();
-                System.out.println(new VBA(parser).visit(tree));
+		out.flush();
 	}
 }
@@ -0,0 +1,32 @@
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+from __future__ import print_function
+
+import shutil
+import tempfile
+import unittest
+
+from cache import DiskCache
+
+class DiskCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._path)
+
+    def test_replace(self):
+        cache = DiskCache(self._path, 1 << 20)
+        for _ in range(3):
+            cache.put('0123', b'data')
+        self.assertEqual(cache._size, DiskCache(self._path, 1 << 20)._size)
+        self.assertEqual(cache.get('0123'), b'data')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+from __future__ import print_function
+
+from distutils.spawn import find_executable
+import unittest
+
+from cleaner import Cleaner
+from parser import Parser
+
+LOOP = '''Sub A()
+    Do While c
+        y = x
+        x = 1
+    Loop
+End Sub
+'''
+
+EXIT = '''Sub A()
+    If c Then
+        x = 1
+        Exit Sub
+    End If
+    y = x
+End Sub
+'''
+
+@unittest.skipUnless(find_executable('java'), 'needs the parser')
+class CleanerTest(unittest.TestCase):
+
+    def _clean(self, data):
+        parsed = Parser([data])
+        (success, _, _) = Cleaner().clean(Parser.findall(parsed.body, 'subStmt')[0], 'A')
+        self.assertTrue(success)
+        return parsed.get_text()
+
+    def test_set_in_loop(self):
+        # x = 1 reaches y = x on the next iteration: x is a variable
+        text = self._clean(LOOP)
+        self.assertNotIn('y = x', text)
+        self.assertNotIn('x = 1', text)
+        self.assertIn('Do While c', text)
+
+    def test_set_before_exit(self):
+        # x = 1 never runs before y = x: x may be anything there
+        text = self._clean(EXIT)
+        self.assertIn('y = x', text)
+        self.assertIn('x = 1', text)
+
+if __name__ == '__main__':
+    unittest.main()
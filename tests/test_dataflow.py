@@ -0,0 +1,113 @@
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+from __future__ import print_function
+
+from distutils.spawn import find_executable
+import unittest
+
+from dataflow import Dataflow
+from parser import Parser
+
+LOOP = '''Sub A()
+    Dim x
+    x = 1
+    Do While x < 3
+        y = x
+        x = x + 1
+    Loop
+End Sub
+'''
+
+GOTO = '''Sub A()
+    Dim x
+L1:
+    y = x
+    x = 1
+    GoTo L1
+End Sub
+'''
+
+EXIT = '''Sub A()
+    Dim x
+    If y Then
+        x = 1
+        Exit Sub
+    End If
+    z = x
+End Sub
+'''
+
+TWO = '''Sub A()
+    x = 1
+End Sub
+Sub B()
+    y = 1
+End Sub
+'''
+
+@unittest.skipUnless(find_executable('java'), 'needs the parser')
+class DataflowTest(unittest.TestCase):
+
+    def _dataflow(self, data):
+        parsed = Parser([data])
+        proc = Parser.findall(parsed.body, 'subStmt')[0]
+        # Block statements by their first line
+        statements = dict((''.join(Parser.get_node_text(node)).strip().split('\n')[0].strip(), node)
+                          for node in Parser.findall(proc, 'blockStmt'))
+        return (Dataflow.of(proc), statements)
+
+    def test_loop(self):
+        (dataflow, statements) = self._dataflow(LOOP)
+        # Read by the loop condition, through the back edge
+        self.assertIn('x', dataflow.live_after(statements['x = x + 1']['children'][0]))
+        self.assertNotIn('x', dataflow.live_after(statements['Dim x']['children'][0]))
+        # Undeclared: may be read after the procedure
+        self.assertIn('y', dataflow.live_after(statements['y = x']['children'][0]))
+        self.assertEqual(dataflow.uninitialized(), set())
+        before = dataflow.defined_before(statements['y = x'])
+        self.assertTrue(before & dataflow.definitions(statements['x = 1'], 'x'))
+        self.assertTrue(before & dataflow.definitions(statements['x = x + 1'], 'x'))
+        # No kills: always overwritten by x = 1, the Dim still counts
+        self.assertTrue(before & dataflow.definitions(statements['Dim x'], 'x'))
+        self.assertFalse(dataflow.defined_before(statements['Dim x']))
+
+    def test_goto(self):
+        (dataflow, statements) = self._dataflow(GOTO)
+        self.assertIn('x', dataflow.live_after(statements['x = 1']['children'][0]))
+        self.assertEqual(dataflow.uninitialized(), set(['x']))
+        before = dataflow.defined_before(statements['y = x'])
+        self.assertTrue(before & dataflow.definitions(statements['x = 1'], 'x'))
+        self.assertTrue(before & dataflow.definitions(statements['Dim x'], 'x'))
+
+    def test_exit(self):
+        (dataflow, statements) = self._dataflow(EXIT)
+        self.assertNotIn('x', dataflow.live_after(statements['x = 1']['children'][0]))
+        self.assertEqual(dataflow.uninitialized(), set(['x']))
+        # z is not set on the way out through the Exit
+        self.assertEqual(dataflow.upward_exposed(), set(['y', 'z']))
+        before = dataflow.defined_before(statements['z = x'])
+        self.assertFalse(before & dataflow.definitions(statements['x = 1'], 'x'))
+        self.assertTrue(before & dataflow.definitions(statements['Dim x'], 'x'))
+        # The If statement makes it, but it does not get past the Exit
+        self.assertTrue(dataflow.definitions(statements['If y Then']))
+
+    def test_cache(self):
+        parsed = Parser([TWO])
+        (a, b) = Parser.findall(parsed.body, 'subStmt')
+        dataflow = Dataflow.of(a)
+        self.assertIs(Dataflow.of(a), dataflow)
+        # A change elsewhere keeps it, one in the procedure drops it
+        literal = Parser.findall(b, 'SHORTLITERAL')[0]
+        literal['value'] = '2'
+        self.assertIs(Dataflow.of(a), dataflow)
+        literal = Parser.findall(a, 'SHORTLITERAL')[0]
+        literal['value'] = '2'
+        self.assertIsNot(Dataflow.of(a), dataflow)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+from __future__ import print_function
+
+from distutils.spawn import find_executable
+import shutil
+import tempfile
+import unittest
+
+from cache import DiskCache
+from deobfuscator import Deobfuscator
+
+NON_ASCII = u'''Function Key()
+  Key = "\xe9t\xe9"
+End Function
+Sub Main()
+  a = Key
+  MsgBox a
+End Sub
+'''
+
+# B sets the x of the module, and A would read it
+GLOBAL = '''Sub B()
+  x = 2
+End Sub
+Sub A()
+  Dim x
+  x = 1
+  B
+  MsgBox x
+End Sub
+'''
+
+# Inlined, the x of B would clobber the one of A
+SHARED = '''Sub B()
+  Dim x
+  x = 2
+  MsgBox x
+End Sub
+Sub A()
+  Dim x
+  x = 1
+  B
+  MsgBox x
+End Sub
+'''
+
+LOCAL = '''Sub B()
+  Dim x
+  x = 2
+  MsgBox x
+End Sub
+Sub A()
+  Dim y
+  y = 1
+  B
+  MsgBox y
+End Sub
+'''
+
+# The CFG does not go into #If: the call site has no known position
+MACRO = '''Sub B()
+  Dim x
+  x = 2
+  MsgBox x
+End Sub
+Sub A()
+  Dim x
+  x = 1
+#If VBA7 Then
+  B
+#End If
+  MsgBox x
+End Sub
+'''
+
+class TranslationCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self._path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        Deobfuscator.CACHE = None
+        shutil.rmtree(self._path)
+
+    def _resolve(self, data):
+        deob = Deobfuscator([data])
+        deob.clean_ids()
+        deob.clean_resolvable()
+        return deob.get_text()
+
+    def test_key_non_ascii(self):
+        key = Deobfuscator._cache_key(b'translation', u'01\n\xe9')
+        self.assertEqual(key, Deobfuscator._cache_key(b'translation', u'01\n\xe9'.encode('utf-8')))
+        self.assertNotEqual(key, Deobfuscator._cache_key(b'translation', u'01\ne'))
+
+    @unittest.skipUnless(find_executable('java'), 'needs the parser')
+    def test_non_ascii_literal(self):
+        expected = self._resolve(NON_ASCII)
+        self.assertIn(u'_a_ = "\xe9t\xe9"', expected)
+        Deobfuscator.CACHE = DiskCache(self._path, 1 << 20)
+        self.assertEqual(self._resolve(NON_ASCII), expected)
+        self.assertEqual(Deobfuscator.CACHE.hits, 0)
+        self.assertEqual(self._resolve(NON_ASCII), expected)
+        self.assertEqual(Deobfuscator.CACHE.misses, Deobfuscator.CACHE.hits)
+
+@unittest.skipUnless(find_executable('java'), 'needs the parser')
+class InlineTest(unittest.TestCase):
+
+    def _inline(self, data):
+        deob = Deobfuscator([data])
+        deob.inline_functions()
+        return deob.get_text()
+
+    def test_global(self):
+        self.assertIn('Sub B()', self._inline(GLOBAL))
+
+    def test_shared(self):
+        self.assertIn('Sub B()', self._inline(SHARED))
+
+    def test_local(self):
+        text = self._inline(LOCAL)
+        self.assertNotIn('Sub B()', text)
+        self.assertLess(text.index('x = 2'), text.index('MsgBox y'))
+
+    def test_macro(self):
+        self.assertIn('Sub B()', self._inline(MACRO))
+
+if __name__ == '__main__':
+    unittest.main()
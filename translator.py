@@ -64,12 +64,12 @@ def return_or_block(func):
     def wrapped(self, *args, **kwargs):
         val = func(self, *args, **kwargs)
         if self._failed:
-            if 'raw' in kwargs and kwargs['raw']:
+            if kwargs.get('raw'):
                 return (None, None)
-            if 'formatted' in kwargs and not kwargs['formatted']:
+            if not kwargs.get('formatted', True):
                 return []
             return
-        if 'ret' in kwargs and kwargs['ret']:
+        if kwargs.get('ret'):
             return val
         self._add_line(val)
     return wrapped
@@ -77,8 +77,7 @@ def return_or_block(func):
 def block_only(func):
     @wraps(func)
     def wrapped(self, *args, **kwargs):
-        if (('left' in kwargs and kwargs ['left']) or
-                ('ret' in kwargs and kwargs['ret'])):
+        if kwargs.get('left') or kwargs.get('ret'):
             self._failed = True
             self.debug('Calling error (block_only: {0} {1}'.format(str(kwargs['left']), str(kwargs['ret'])))
         else:
@@ -119,12 +118,12 @@ class Translator(object):
 
     def _handle(self, node, **kwargs):
         try:
-            func = getattr(self, '_handle_{0}'.format(node['name']))
-        except AttributeError:
+            func = self._DISPATCH[node['name']]
+        except KeyError:
             self._failed = True
             self.debug("Can't handle: " + node['name'])
             return
-        return func(node, **kwargs)
+        return func(self, node, **kwargs)
 
     def __pass(self, node, ret=False, left=False):
         pass
@@ -950,5 +949,12 @@ class Translator(object):
     def parsed(self):
         return not self._failed
 
+    def code(self):
+        # Unicode as soon as the procedure has non-ASCII text, which str()
+        # can't return under Python 2
+        return self._code
+
     def __str__(self):
         return self._code
+
+Translator._DISPATCH = Parser.dispatch_table(Translator)
@@ -11,13 +11,14 @@ from django.db import transaction
 from deobfuscator import Deobfuscator
 
 from ..models import Sample, RawVBA, DecodedVBA
-from ..utils import hash
+from ..utils import hash, parser_stats, setup_parser
 
 class SampleDecoder(object):
 
     def __init__(self, remote=False):
         if remote:
             raise NotImplementedError
+        setup_parser()
 
     def _get(self):
         return Sample.objects.all().filter(decoded__isnull=True)
@@ -52,3 +53,4 @@ class SampleDecoder(object):
             samples = self._get()
         for sample in samples:
             self._process(sample)
+        parser_stats()
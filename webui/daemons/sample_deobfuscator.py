@@ -11,13 +11,19 @@ from django.db import transaction
 from deobfuscator import Deobfuscator
 
 from ..models import Sample, DecodedVBA, DeobfuscatedVBA
-from ..utils import hash
+from ..utils import hash, parser_stats, setup_parser
 
 class SampleDeobfuscator(object):
 
     def __init__(self, remote=False):
         if remote:
             raise NotImplementedError
+        setup_parser()
+        # Samples can't hang or exhaust the daemon through the emulation
+        Deobfuscator.EMULATION_WORKERS = settings.EMULATION['WORKERS']
+        Deobfuscator.EMULATION_CPU = settings.EMULATION['CPU']
+        Deobfuscator.EMULATION_MEMORY = settings.EMULATION['MEMORY']
+        Deobfuscator.EMULATION_TIMEOUT = settings.EMULATION['TIMEOUT']
 
     def _get(self):
         return Sample.objects.all().filter(deobfuscated__isnull=True, decoded__isnull=False).select_related('decoded')
@@ -47,3 +53,4 @@ class SampleDeobfuscator(object):
             samples = self._get()
         for sample in samples:
             self._process(sample)
+        parser_stats()
@@ -120,3 +120,17 @@ EMAIL_FEEDER = {
   'MAILBOX':    config.get('EmailFeeder', 'mailbox'),
   'MAXBACKOFF': config.get('EmailFeeder', 'maxbackoff'),
 }
+
+PARSER = {
+  'CACHE_PATH': config.get('Parser', 'cache_path'),
+  'CACHE_SIZE': config.getint('Parser', 'cache_size') * 1024 * 1024,
+  'TIMEOUT':    config.getint('Parser', 'timeout'),
+  'NORMALIZE':  config.getboolean('Parser', 'normalize'),
+}
+
+EMULATION = {
+  'WORKERS': config.getint('Emulation', 'workers'),
+  'CPU':     config.getint('Emulation', 'cpu'),
+  'MEMORY':  config.getint('Emulation', 'memory') * 1024 * 1024,
+  'TIMEOUT': config.getint('Emulation', 'timeout'),
+}
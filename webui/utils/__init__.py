@@ -1,3 +1,4 @@
 from .process_email import process_email
 from .process_sample import process_file
 from .hasher import hash
+from .parsing import setup_parser, parser_stats
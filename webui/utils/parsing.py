@@ -0,0 +1,30 @@
+# Copyright (C) 2016, CERN
+# This software is distributed under the terms of the GNU General Public
+# Licence version 3 (GPL Version 3), copied verbatim in the file "COPYING".
+# In applying this license, CERN does not waive the privileges and immunities
+# granted to it by virtue of its status as Intergovernmental Organization
+# or submit itself to any jurisdiction.
+
+from django.conf import settings
+
+from cache import DiskCache
+from deobfuscator import Deobfuscator
+from parser import Parser
+
+def setup_parser():
+    if not settings.PARSER['NORMALIZE']:
+        Parser.NORMALIZER = None
+    if settings.PARSER['TIMEOUT']:
+        Parser.TIMEOUT = settings.PARSER['TIMEOUT']
+    if settings.PARSER['CACHE_PATH'] and Parser.CACHE is None:
+        Parser.CACHE = DiskCache(settings.PARSER['CACHE_PATH'], settings.PARSER['CACHE_SIZE'])
+        # Translations of the procedures go along with their parse trees
+        Deobfuscator.CACHE = Parser.CACHE
+
+def parser_stats():
+    if Parser.NORMALIZER is not None:
+        print('Normalization: {0}'.format(Parser.NORMALIZER.stats()))
+        # Per batch of samples
+        Parser.NORMALIZER.reset()
+    if Parser.CACHE is not None:
+        print('Parse and translation cache: {0}'.format(Parser.CACHE.stats()))